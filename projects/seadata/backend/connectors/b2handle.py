@@ -3,15 +3,23 @@
 """
 
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from b2handle.clientcredentials import PIDClientCredentials as credentials
 from b2handle.handleclient import EUDATHandleClient as b2handle
 from restapi.utilities.logs import log
 from seadata.connectors import irods
+from seadata.connectors.pids_cache import PIDCache
 
 HandleClient = Any
+# Separator of the paths sent to the batched PID rule,
+# paths containing it are never sent to the rule
+PATHS_SEPARATOR = "|"
+# Prefix of the rule output for paths that failed to obtain a PID
+PID_ERROR_PREFIX = "!"
 
 
 class PIDgenerator:
@@ -26,6 +34,8 @@ class PIDgenerator:
     """
 
     pid_separator = "/"
+    # read-only client, reused by all the PID resolutions of the process
+    read_client: Optional[HandleClient] = None
 
     eudat_pid_fields = [
         "URL",
@@ -66,6 +76,124 @@ def pid_request(self, icom: irods.IrodsPythonExt, ipath: str) -> str:
         rule_output = icom.rule("get_pid", body, inputs)
         return self.pid_name_fix(rule_output)
 
+    def pid_batch_request(
+        self, icom: irods.IrodsPythonExt, ipaths: List[str]
+    ) -> Dict[str, str]:
+        """
+        EUDAT RULE for PID, executed for a list of paths in a single run.
+        Returns the PIDs obtained, paths that failed are not included
+        """
+
+        inputs = {
+            "*paths": f'"{PATHS_SEPARATOR.join(ipaths)}"',
+            "*fixed": '"true"',
+            # empty variables
+            "*parent_pid": '""',
+            "*ror": '""',
+            "*fio": '""',
+        }
+        # whitespaces are removed from the output, each PID ends with ;
+        body = f"""
+            foreach(*path in split(*paths, "{PATHS_SEPARATOR}")) {{
+                *newPID = "";
+                *err = errorcode(
+                    EUDATCreatePID(*parent_pid, *path, *ror, *fio, *fixed, *newPID)
+                );
+                if (*err < 0 || *newPID == "") {{
+                    writeLine("stdout", "{PID_ERROR_PREFIX}*err;");
+                }} else {{
+                    writeLine("stdout", "*newPID;");
+                }}
+            }}
+        """
+
+        # the rule is not idempotent: a repeated run could mint a second PID
+        rule_output = icom.execute_rule("get_pids", body, inputs)
+        outputs = rule_output.rstrip(";").split(";")
+        if len(outputs) != len(ipaths):
+            log.error(
+                "Unexpected output from PID rule: {} PIDs for {} paths",
+                len(outputs),
+                len(ipaths),
+            )
+            return {}
+
+        pids: Dict[str, str] = {}
+        for ipath, output in zip(ipaths, outputs):
+            if not output or output.startswith(PID_ERROR_PREFIX):
+                log.error("Failed PID request for {} ({})", ipath, output)
+                continue
+            pids[ipath] = self.pid_name_fix(output)
+        return pids
+
+    def mint_pids(
+        self,
+        icom: irods.IrodsPythonExt,
+        ipaths: List[str],
+        batch_size: int = 100,
+        retries: int = 3,
+        wait: int = 10,
+    ) -> Tuple[Dict[str, str], List[str]]:
+        """
+        Mint the PIDs of a list of paths, running one rule for each batch.
+        Only the failed paths are sent again, up to `retries` times, after
+        checking that they did not obtain a PID anyway.
+        Returns the path->PID mapping and the paths without a PID
+        """
+
+        pids: Dict[str, str] = {}
+        missing = list(dict.fromkeys(ipaths))
+        rejected = [p for p in missing if PATHS_SEPARATOR in p]
+        if rejected:
+            log.error(
+                "{} paths contain {} and cannot obtain a PID: {}",
+                len(rejected),
+                PATHS_SEPARATOR,
+                rejected,
+            )
+            missing = [p for p in missing if PATHS_SEPARATOR not in p]
+
+        for attempt in range(1, retries + 1):
+            if attempt > 1:
+                # a failed or incomplete rule run may have minted some PIDs
+                pids.update(self.get_existing_pids(icom, missing))
+                missing = [p for p in missing if p not in pids]
+                if not missing:
+                    break
+            for i in range(0, len(missing), batch_size):
+                batch = missing[i : i + batch_size]
+                try:
+                    pids.update(self.pid_batch_request(icom, batch))
+                except BaseException as e:
+                    log.error("PID rule failed for {} paths: {}", len(batch), e)
+
+            missing = [p for p in missing if p not in pids]
+            log.info("{} PIDs minted, {} missing", len(pids), len(missing))
+            if not missing or attempt == retries:
+                break
+            log.warning("PID requests retry {}/{}", attempt, retries - 1)
+            time.sleep(wait)
+
+        return pids, missing + rejected
+
+    def get_existing_pids(
+        self, icom: irods.IrodsPythonExt, ipaths: List[str]
+    ) -> Dict[str, str]:
+        """PIDs already assigned to the paths, read from their PID metadata"""
+
+        pids: Dict[str, str] = {}
+        for ipath in ipaths:
+            try:
+                pid = icom.get_metadata(ipath).get("PID")
+            except BaseException as e:
+                log.warning("Cannot read the PID of {}: {}", ipath, e)
+                continue
+            if pid:
+                pids[ipath] = self.pid_name_fix(pid)
+        if pids:
+            log.info("{} paths already have a PID", len(pids))
+        return pids
+
     def parse_pid_dataobject_path(
         self, metadata: Any, key: str = "URL"
     ) -> Optional[Path]:
@@ -99,6 +227,63 @@ def parse_pid_dataobject_path(
 
         return ipath
 
+    def resolve_pids(
+        self,
+        cache: PIDCache,
+        client: HandleClient,
+        pids: List[str],
+        workers: int = 8,
+    ) -> Tuple[Dict[str, Path], List[str]]:
+        """
+        Resolve a list of PIDs into iRODS paths.
+        Cached PIDs are read with pipelined lookups, the misses are resolved
+        by a bounded pool of b2handle lookups and written back to the cache.
+        Returns the resolved paths (in input order) and the PIDs not found.
+        Errors raised by b2handle are propagated to the caller.
+        """
+
+        unique_pids = list(dict.fromkeys(pids))
+        paths = {pid: Path(path) for pid, path in cache.lookup(unique_pids).items()}
+        misses = [pid for pid in unique_pids if pid not in paths]
+
+        log.info(
+            "{} PIDs found in cache, {} to be resolved with b2handle",
+            len(paths),
+            len(misses),
+        )
+
+        not_found: List[str] = []
+        resolved: Dict[str, str] = {}
+        if misses:
+            executor = ThreadPoolExecutor(max_workers=workers)
+            try:
+                records = executor.map(client.retrieve_handle_record, misses)
+                for pid, record in zip(misses, records):
+                    if record is None:
+                        log.warning("PID not found: {}", pid)
+                        not_found.append(pid)
+                        continue
+
+                    pid_path = self.parse_pid_dataobject_path(record)
+                    if not pid_path:
+                        log.error("Can't extract a PID from {}", record)
+                        continue
+
+                    log.debug("PID verified: {}\n({})", pid, pid_path)
+                    paths[pid] = pid_path
+                    resolved[pid] = str(pid_path)
+            finally:
+                # if one lookup failed, cancel the ones not started yet
+                # (the running ones are awaited)
+                executor.shutdown(wait=True, cancel_futures=True)
+
+        if resolved:
+            cache.store(resolved)
+            log.debug("PID cache updated with {} PIDs", len(resolved))
+
+        files = {pid: paths[pid] for pid in unique_pids if pid in paths}
+        return files, not_found
+
     def connect_client(
         self, force_no_credentials: bool = False, disable_logs: bool = False
     ) -> Tuple[HandleClient, bool]:
@@ -135,7 +320,8 @@ def connect_client(
         return handle_client, False
 
     def check_pid_content(self, pid: str) -> Any:
-        client, authenticated = self.connect_client(
-            force_no_credentials=True, disable_logs=True
-        )
-        return client.retrieve_handle_record(pid)
+        if PIDgenerator.read_client is None:
+            PIDgenerator.read_client, _ = self.connect_client(
+                force_no_credentials=True, disable_logs=True
+            )
+        return PIDgenerator.read_client.retrieve_handle_record(pid)
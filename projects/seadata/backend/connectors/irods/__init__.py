@@ -1,16 +1,40 @@
 """
 iRODS file-system flask connector
 """
+import hashlib
 import logging
 import os
 import re
+import secrets
+import string
 import textwrap
+import time
+from datetime import timezone
 from pathlib import Path
-from typing import Any, Dict, Iterator, Optional, Union, cast
-
-from flask import Response, stream_with_context
+from threading import Lock
+from types import TracebackType
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+    cast,
+)
+
+from flask import Response, has_request_context, stream_with_context
 from irods import exception as iexceptions
+from irods import keywords, models
 from irods.access import iRODSAccess
+from irods.api_number import api_number
+from irods.column import Like
+from irods.message import TicketAdminRequest, iRODSMessage
+from irods.meta import AVUOperation, iRODSMeta
 from irods.rule import Rule
 from irods.session import iRODSSession
 from irods.ticket import Ticket
@@ -18,6 +42,14 @@
 from restapi.env import Env
 from restapi.exceptions import RestApiException, ServiceUnavailable
 from restapi.utilities.logs import log
+from seadata.connectors.irods.retry import retry_policy
+from werkzeug.http import (
+    http_date,
+    parse_date,
+    parse_etags,
+    parse_range_header,
+    unquote_etag,
+)
 
 # is python irods client typed !?
 DataObject = Any
@@ -28,6 +60,19 @@
 NORMAL_AUTH_SCHEME = "credentials"
 PAM_AUTH_SCHEME = "PAM"
 DEFAULT_CHUNK_SIZE = 1_048_576
+# Files larger than this are transferred over parallel streams
+DEFAULT_PARALLEL_THRESHOLD = 33_554_432
+DEFAULT_TRANSFER_THREADS = 4
+DEFAULT_BUFFER_SIZE = 4_194_304
+# Tickets codes are made of these characters, to be used in URLs as they are
+TICKET_CHARS = string.ascii_letters + string.digits
+TICKET_LENGTH = 20
+# Idle sessions kept for each set of credentials
+DEFAULT_POOL_MAX_SIZE = 4
+# Seconds after which an idle session is closed
+DEFAULT_POOL_MAX_IDLE = 300
+# Seconds after which an idle session is verified before being reused
+DEFAULT_POOL_VERIFICATION = 60
 
 
 class IrodsException(RestApiException):
@@ -42,8 +87,25 @@ class IrodsPythonExt(Connector):
 
     def __init__(self) -> None:
         self.prc_session = None
+        # set while the session is checked out from the pool
+        self.pool_key: Optional[PoolKey] = None
+        self.created_at = time.monotonic()
+        self.ticket: Optional[str] = None
+        # set when a with block exits on an exception, never pooled again
+        self.broken = False
         super().__init__()
 
+    def __exit__(
+        self,
+        exctype: Optional[Type[Exception]],
+        excinst: Optional[Exception],
+        exctb: Optional[TracebackType],
+    ) -> bool:
+        # the socket could have been left in an unknown state
+        if excinst is not None:
+            self.broken = True
+        return super().__exit__(exctype, excinst, exctb)
+
     @property
     def prc(self) -> Any:
         if self.prc_session:
@@ -122,10 +184,27 @@ def connect(self, **kwargs: str) -> "IrodsPythonExt":
         return self
 
     def disconnect(self) -> None:
+        if self.pool_key is not None and not self.disconnected:
+            # pooled sessions are released to be reused by the next task
+            self.disconnected = True
+            pool.release(self, broken=self.broken)
+            return
+        self.close()
+
+    def close(self) -> None:
+        """Close the connections of the session, even if pooled"""
         self.disconnected = True
+        self.pool_key = None
         if self.prc_session:
             self.prc_session.cleanup()
 
+    def is_healthy(self) -> bool:
+        try:
+            return bool(self.prc.collections.exists(f"/{self.prc.zone}"))
+        except BaseException as e:
+            log.warning("Discarding broken iRODS session: {}", e)
+            return False
+
     def is_connected(self) -> bool:
 
         return not self.disconnected
@@ -165,62 +244,165 @@ def list(
         recursive: bool = False,
         detailed: bool = False,
     ) -> Dict[str, Dict[str, Any]]:
-        """List the files inside an iRODS path/collection"""
+        """
+        List the files inside an iRODS path/collection.
+        Names and details of all the entries are read with one catalog query
+        for the subcollections and one for the data objects, paged by the
+        client through the query continuation
+        """
 
         if path is None:
             path = self.get_user_home()
 
-        if self.is_dataobject(path):
-            raise IrodsException("Cannot list a Data Object; you may get it instead.")
+        if not self.is_collection(path):
+            if self.is_dataobject(path):
+                raise IrodsException(
+                    "Cannot list a Data Object; you may get it instead."
+                )
+            raise IrodsException(f"Not found (or no permission): {path}")
 
-        try:
-            data: Dict[str, Dict[str, Any]] = {}
-            root = self.prc.collections.get(path)
-
-            for coll in root.subcollections:
-
-                row: Dict[str, Any] = {}
-                key = coll.name
-                row["name"] = coll.name
-                row["objects"] = {}
-                if recursive:
-                    row["objects"] = self.list(
-                        path=coll.path,
-                        recursive=recursive,
-                        detailed=detailed,
-                    )
-                row["path"] = os.path.dirname(coll.path)
-                row["object_type"] = "collection"
-                if detailed:
-                    row["owner"] = "-"
-
-                data[key] = row
-
-            for obj in root.data_objects:
-
-                row = {}
-                key = obj.name
-                row["name"] = obj.name
-                row["path"] = os.path.dirname(obj.path)
-                row["object_type"] = "dataobject"
-
-                if detailed:
-                    row["owner"] = obj.owner_name
-                    row["content_length"] = obj.size
-                    row["created"] = obj.create_time
-                    row["last_modified"] = obj.modify_time
-
-                data[key] = row
+        data: Dict[str, Dict[str, Any]] = {}
+        path = path.rstrip("/") or "/"
 
-            return data
-        except iexceptions.CollectionDoesNotExist:
-            raise IrodsException(f"Not found (or no permission): {path}")
+        query = self.prc.query(models.Collection.name).filter(
+            models.Collection.parent_name == path
+        )
+        for result in query:
+            coll_path = result[models.Collection.name]
+            # the root collection is its own parent
+            if coll_path == path:
+                continue
+            name = os.path.basename(coll_path)
+            row: Dict[str, Any] = {
+                "name": name,
+                "objects": {},
+                "path": path,
+                "object_type": "collection",
+            }
+            if recursive:
+                row["objects"] = self.list(
+                    path=coll_path, recursive=recursive, detailed=detailed
+                )
+            if detailed:
+                row["owner"] = "-"
+            data[name] = row
+
+        columns = [models.DataObject.name]
+        if detailed:
+            columns += [
+                models.DataObject.owner_name,
+                models.DataObject.size,
+                models.DataObject.create_time,
+                models.DataObject.modify_time,
+            ]
+        query = self.prc.query(*columns).filter(models.Collection.name == path)
+        for result in query:
+            name = result[models.DataObject.name]
+            # a row is returned for each replica
+            if name in data:
+                continue
+            row = {"name": name, "path": path, "object_type": "dataobject"}
+            if detailed:
+                row["owner"] = result[models.DataObject.owner_name]
+                row["content_length"] = result[models.DataObject.size]
+                row["created"] = result[models.DataObject.create_time]
+                row["last_modified"] = result[models.DataObject.modify_time]
+            data[name] = row
+
+        return data
 
         # replicas = []
         # for line in lines:
         #     replicas.append(re.split("\s+", line.strip()))
         # return replicas
 
+    def query_tree(
+        self, path: str, columns: List[Any], criteria: Optional[List[Any]] = None
+    ) -> Iterator[Any]:
+        """
+        Catalog query on the data objects of a collection and its
+        subcollections: one query for the collection itself and one for
+        the collections below it, as LIKE cannot match both.
+        Rows are sorted by collection and object name
+        """
+
+        for collection_filter in (
+            models.Collection.name == path,
+            Like(models.Collection.name, f"{path}/%"),
+        ):
+            query = (
+                self.prc.query(models.Collection.name, *columns)
+                .filter(collection_filter, *(criteria or []))
+                .order_by(models.Collection.name)
+                .order_by(models.DataObject.name)
+            )
+            # results are paged by the client through the query continuation
+            for result in query:
+                collection = result[models.Collection.name]
+                # _ and % in the path are wildcards for LIKE
+                if collection == path or collection.startswith(f"{path}/"):
+                    yield result
+
+    def iterate_pids(self, path: str) -> Iterator[Tuple[str, str]]:
+        """
+        Yield path and PID of the data objects found in the collection and
+        its subcollections, joining objects and PID AVUs in the catalog query
+        """
+
+        query = self.query_tree(
+            path.rstrip("/"),
+            [models.DataObject.name, models.DataObjectMeta.value],
+            [models.DataObjectMeta.name == "PID"],
+        )
+        for result in query:
+            ifile = f"{result[models.Collection.name]}/{result[models.DataObject.name]}"
+            yield ifile, result[models.DataObjectMeta.value]
+
+    def iterate_files(
+        self, path: str
+    ) -> Iterator[Tuple[str, int, Optional[str], Optional[str]]]:
+        """
+        Yield path, size, checksum and PID of all the data objects found
+        in the collection and its subcollections, with one catalog query
+        for the objects and one for their PIDs.
+        Both are streamed in the same order and joined as they are read,
+        so the memory does not grow with the size of the tree. Objects
+        added or removed during the iteration may be yielded without PID
+        """
+
+        path = path.rstrip("/")
+        # objects with a PID are a subset of the objects, in the same order
+        pids = self.iterate_pids(path)
+        next_pid = next(pids, None)
+
+        previous = None
+        query = self.query_tree(
+            path,
+            [
+                models.DataObject.name,
+                models.DataObject.size,
+                models.DataObject.checksum,
+            ],
+        )
+        for result in query:
+            ifile = f"{result[models.Collection.name]}/{result[models.DataObject.name]}"
+            # a row is returned for each replica, one after the other
+            if ifile == previous:
+                continue
+            previous = ifile
+
+            pid = None
+            while next_pid is not None and next_pid[0] == ifile:
+                pid = next_pid[1]
+                next_pid = next(pids, None)
+
+            yield (
+                ifile,
+                int(result[models.DataObject.size]),
+                result[models.DataObject.checksum],
+                pid,
+            )
+
     def create_empty(
         self, path: str, directory: bool = False, ignore_existing: bool = False
     ) -> bool:
@@ -277,9 +459,68 @@ def create_file(self, path: str, ignore_existing: bool = False) -> bool:
 
         return False
 
+    def get_transfer_threads(self, size: int) -> int:
+        """
+        A single stream for small files, parallel streams for large ones.
+        Returns the number of streams actually used by the client, that
+        transfers over a single stream with servers older than 4.2.9
+        and with files up to 32 MB in any case
+        """
+        threshold = Env.to_int(
+            self.variables.get("parallel_threshold"), DEFAULT_PARALLEL_THRESHOLD
+        )
+        if size < threshold:
+            return 1
+        threads = Env.to_int(
+            self.variables.get("transfer_threads"), DEFAULT_TRANSFER_THREADS
+        )
+        if not self.prc.data_objects.should_parallelize_transfer(threads, size):
+            return 1
+        return threads
+
+    def set_buffer_size(self) -> None:
+        buffer_size = Env.to_int(self.variables.get("buffer_size"), DEFAULT_BUFFER_SIZE)
+        self.prc.data_objects.READ_BUFFER_SIZE = buffer_size
+        self.prc.data_objects.WRITE_BUFFER_SIZE = buffer_size
+
+    @staticmethod
+    def log_throughput(action: str, path: str, size: int, start: float) -> None:
+        elapsed = max(time.monotonic() - start, 0.001)
+        log.info(
+            "{} {} ({:.1f} MB) in {:.1f}s, {:.1f} MB/s",
+            action,
+            path,
+            size / 1_048_576,
+            elapsed,
+            size / 1_048_576 / elapsed,
+        )
+
+    @retry_policy
     def put(self, local_path: str, irods_path: str) -> None:
+        size = os.path.getsize(local_path)
+        threads = self.get_transfer_threads(size)
+        self.set_buffer_size()
+        start = time.monotonic()
         # NOTE: this action always overwrite
-        self.prc.data_objects.put(local_path, irods_path)
+        self.prc.data_objects.put(local_path, irods_path, num_threads=threads)
+        self.log_throughput(f"Uploaded ({threads} streams)", irods_path, size, start)
+
+    @retry_policy
+    def get(self, irods_path: str, local_path: str) -> None:
+        obj = self.prc.data_objects.get(irods_path)
+        threads = self.get_transfer_threads(obj.size)
+        self.set_buffer_size()
+        start = time.monotonic()
+        # NOTE: this action always overwrite, as the previous open/copy did
+        self.prc.data_objects.get(
+            irods_path,
+            local_path,
+            num_threads=threads,
+            **{keywords.FORCE_FLAG_KW: ""},
+        )
+        self.log_throughput(
+            f"Downloaded ({threads} streams)", irods_path, obj.size, start
+        )
 
     def move(self, src_path: Path, dest_path: Path) -> None:
 
@@ -324,6 +565,7 @@ def remove(
         except iexceptions.CAT_NO_ROWS_FOUND:
             raise IrodsException("Irods delete error: path not found")
 
+    @retry_policy
     def write_file_content(self, path: str, content: str, position: int = 0) -> None:
         try:
             obj = self.prc.data_objects.get(path)
@@ -342,16 +584,18 @@ def write_file_content(self, path: str, content: str, position: int = 0) -> None
         except iexceptions.DataObjectDoesNotExist:
             raise IrodsException("Cannot write to file: not found")
 
-    def open(self, absolute_path: str, destination: str) -> None:
-
+    def read_file_content(self, path: str) -> str:
         try:
-            obj = self.prc.data_objects.get(absolute_path)
-
+            obj = self.prc.data_objects.get(path)
             with obj.open("r") as handle:
-                with open(destination, "wb") as target:
-                    for line in handle:
-                        target.write(line)
+                return cast(bytes, handle.read()).decode()
+        except iexceptions.DataObjectDoesNotExist:
+            raise IrodsException("Cannot read file: not found")
+
+    def open(self, absolute_path: str, destination: str) -> None:
 
+        try:
+            self.get(absolute_path, destination)
         except iexceptions.DataObjectDoesNotExist:
             raise IrodsException("Cannot read path: not found or permssion denied")
         except iexceptions.CollectionDoesNotExist:
@@ -479,6 +723,32 @@ def remove_metadata(self, path: str, key: str) -> None:
         if tmp is not None:
             obj.metadata.remove(tmp)
 
+    def has_metadata(self, path: Union[str, Path], metadata: Dict[str, str]) -> bool:
+        """True if all the AVUs are set on the object, with the same values"""
+
+        if self.is_collection(path):
+            obj = self.prc.collections.get(str(path))
+        else:
+            obj = self.prc.data_objects.get(str(path))
+        avus = {(meta.name, meta.value) for meta in obj.metadata.items()}
+        return all(avu in avus for avu in metadata.items())
+
+    def add_metadata(
+        self, obj: Any, path: Union[str, Path], key: str, value: str
+    ) -> None:
+        """
+        Add an AVU, AVUs already set with the same value are accepted:
+        a retried add could follow an add applied before a network error
+        """
+
+        try:
+            obj.metadata.add(key, value)
+        except iexceptions.CATALOG_ALREADY_HAS_ITEM_BY_THAT_NAME:
+            if not self.has_metadata(path, {key: value}):
+                raise IrodsException("This metadata already exist")
+            log.debug("Metadata {} already set on {}", key, path)
+
+    @retry_policy
     def set_metadata(self, path: str, **meta: str) -> None:
         try:
             if self.is_collection(path):
@@ -487,13 +757,80 @@ def set_metadata(self, path: str, **meta: str) -> None:
                 obj = self.prc.data_objects.get(path)
 
             for key, value in meta.items():
-                obj.metadata.add(key, value)
-        except iexceptions.CATALOG_ALREADY_HAS_ITEM_BY_THAT_NAME:
-            raise IrodsException("This metadata already exist")
+                self.add_metadata(obj, path, key, value)
         except iexceptions.DataObjectDoesNotExist:
             raise IrodsException("Cannot set metadata, object not found")
 
+    @retry_policy
+    def set_metadata_bulk(
+        self,
+        path: Union[str, Path],
+        metadata: Dict[str, str],
+        remove: Optional[List[str]] = None,
+        skip_existing: bool = False,
+    ) -> None:
+        """
+        Apply many metadata changes to an object with a single atomic request:
+        keys in remove lose all their current values, then the AVUs in
+        metadata are added (except existing keys, if skip_existing is set).
+        The object is read first and, with remove or skip_existing, also its
+        metadata: up to three catalog round trips per object in total.
+        Servers without atomic operations get one request per AVU
+        """
+
+        try:
+            obj = self.prc.data_objects.get(str(path))
+        except (iexceptions.CollectionDoesNotExist, iexceptions.DataObjectDoesNotExist):
+            try:
+                obj = self.prc.collections.get(str(path))
+            except iexceptions.CollectionDoesNotExist:
+                raise IrodsException("Cannot set metadata, object not found")
+
+        remove = remove or []
+        current = obj.metadata.items() if remove or skip_existing else []
+
+        operations = [
+            AVUOperation(operation="remove", avu=meta)
+            for meta in current
+            if meta.name in remove
+        ]
+        existing = {meta.name for meta in current if meta.name not in remove}
+        for key, value in metadata.items():
+            if skip_existing and key in existing:
+                continue
+            operations.append(AVUOperation(operation="add", avu=iRODSMeta(key, value)))
+
+        if not operations:
+            return
+
+        added = {
+            op.avu.name: op.avu.value for op in operations if op.operation == "add"
+        }
+        try:
+            obj.metadata.apply_atomic_operations(*operations)
+            return
+        except iexceptions.CATALOG_ALREADY_HAS_ITEM_BY_THAT_NAME:
+            # a retried request could follow one applied before a network error
+            if not self.has_metadata(path, added):
+                raise IrodsException("This metadata already exist")
+            log.debug("Metadata already set on {}", path)
+            return
+        except (iexceptions.SYS_UNMATCHED_API_NUM, iexceptions.SYS_API_INPUT_ERR) as e:
+            # other errors (e.g. network) may come after a committed request
+            log.warning("Atomic metadata operations not supported ({})", e)
+
+        for op in operations:
+            if op.operation == "remove":
+                obj.metadata.remove(op.avu)
+            else:
+                self.add_metadata(obj, path, op.avu.name, op.avu.value)
+
+    @retry_policy
     def rule(self, name: str, body: str, inputs: Dict[str, str]) -> str:
+        return self.execute_rule(name, body, inputs)
+
+    def execute_rule(self, name: str, body: str, inputs: Dict[str, str]) -> str:
+        """Run a rule once, for rules that must not be repeated on failures"""
 
         # A bit complex to use {}.format syntax...
         rule_body = textwrap.dedent(
@@ -562,10 +899,44 @@ def ticket(self, path: str) -> Ticket:  # type: ignore
         ticket.issue("read", path)
         return ticket
 
+    def ticket_admin(self, *commands: Tuple[str, ...]) -> None:
+        """Send ticket administration requests over a single connection"""
+        with self.prc.pool.get_connection() as conn:
+            for args in commands:
+                message = iRODSMessage(
+                    "RODS_API_REQ",
+                    msg=TicketAdminRequest(*args),
+                    int_info=api_number["TICKET_ADMIN_AN"],
+                )
+                conn.send(message)
+                conn.recv()
+
+    def issue_ticket(
+        self, path: str, expires: Optional[int] = None, uses: Optional[int] = None
+    ) -> str:
+        """
+        Create a read ticket with a URL-safe code, optionally expiring at the
+        given epoch time and limited in the number of uses
+        """
+
+        code = "".join(secrets.choice(TICKET_CHARS) for _ in range(TICKET_LENGTH))
+        commands = [("create", code, "read", path)]
+        if expires is not None:
+            commands.append(("mod", code, "expire", str(expires)))
+        if uses is not None:
+            commands.append(("mod", code, "uses", str(uses)))
+        self.ticket_admin(*commands)
+        return code
+
+    def delete_ticket(self, code: str) -> None:
+        self.ticket_admin(("delete", code))
+
     def ticket_supply(self, code: str) -> None:
         # use ticket for access
         ticket = Ticket(self.prc, code)
         ticket.supply()
+        # the ticket is bound to the connection: never reuse it for other users
+        self.ticket = code
 
     def test_ticket(self, path: Path) -> bool:
         try:
@@ -590,18 +961,233 @@ def read_in_chunks(
                 break
             yield data
 
+    def read_range(
+        self, file_object: Any, start: int, length: int, chunk_size: int
+    ) -> Iterator[bytes]:
+        """Read length bytes from start, then close the file"""
+
+        try:
+            file_object.seek(start)
+            while length > 0:
+                data = file_object.read(min(chunk_size, length))
+                if not data:
+                    break
+                length -= len(data)
+                yield data
+        finally:
+            file_object.close()
+
+    def get_validators(self, path: Path) -> Dict[str, str]:
+        """ETag (from the checksum, if any) and Last-Modified of a data object"""
+
+        try:
+            obj = self.prc.data_objects.get(str(path))
+        except BaseException as e:
+            # catalog queries could be not allowed with a ticket
+            log.debug("Cannot read details of {}: {}", path, e)
+            return {}
+
+        modified = obj.modify_time.replace(tzinfo=timezone.utc)
+        if obj.checksum:
+            etag = obj.checksum
+        else:
+            etag = f"{obj.size}-{int(modified.timestamp())}"
+        return {"ETag": f'"{etag}"', "Last-Modified": http_date(modified)}
+
     def stream_ticket(
-        self, path: Path, headers: Optional[Dict[str, str]] = None
+        self,
+        path: Path,
+        headers: Optional[Dict[str, str]] = None,
+        request_headers: Optional[Mapping[str, str]] = None,
     ) -> Response:
+        """
+        Stream a data object honouring the Range, If-Range, If-None-Match and
+        If-Modified-Since request headers, to let clients resume downloads
+        """
+
+        request_headers = request_headers or {}
+        response_headers = dict(headers or {})
+        response_headers["Accept-Ranges"] = "bytes"
+        validators = self.get_validators(path)
+        response_headers.update(validators)
+
+        etag = validators.get("ETag")
+        modified = parse_date(validators.get("Last-Modified"))
+
+        if_none_match = request_headers.get("If-None-Match")
+        if_modified_since = parse_date(request_headers.get("If-Modified-Since"))
+        # lists of (weak) etags are allowed, compared with the weak comparison
+        etags = parse_etags(if_none_match)
+        if (etag and etags.contains_weak(unquote_etag(etag)[0])) or (
+            not if_none_match
+            and modified
+            and if_modified_since
+            and modified <= if_modified_since
+        ):
+            return Response(status=304, headers=validators)
+
         obj = self.prc.data_objects.open(str(path), "r")
+        size = obj.seek(0, os.SEEK_END)
+
+        start, stop, status = 0, size, 200
+        requested = parse_range_header(request_headers.get("Range"))
+        if_range = request_headers.get("If-Range")
+        # a range of a different version of the file would corrupt the download
+        if requested and if_range and if_range != etag:
+            if_range_date = parse_date(if_range)
+            if not modified or not if_range_date or modified > if_range_date:
+                requested = None
+
+        # multiple ranges are not supported, the whole file is sent instead
+        if requested and len(requested.ranges) == 1:
+            byte_range = requested.range_for_length(size)
+            if byte_range is None and requested.ranges[0][0] >= size:
+                obj.close()
+                return Response(
+                    status=416, headers={"Content-Range": f"bytes */{size}"}
+                )
+            if byte_range is not None:
+                start, stop = byte_range
+                status = 206
+                response_headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+
+        response_headers["Content-Length"] = str(stop - start)
         return Response(
-            stream_with_context(self.read_in_chunks(obj, DEFAULT_CHUNK_SIZE)),
-            headers=headers,
+            stream_with_context(
+                self.read_range(obj, start, stop - start, DEFAULT_CHUNK_SIZE)
+            ),
+            status=status,
+            headers=response_headers,
         )
 
 
 instance = IrodsPythonExt()
 
+# user, zone, authentication scheme, host, port and password digest
+PoolKey = Tuple[str, ...]
+
+
+class SessionPool:
+    """
+    iRODS sessions reused by the tasks of a worker process instead of
+    authenticating again for each of them.
+    A session is checked out by a single thread at a time and is released to
+    the pool on disconnect (e.g. at the end of a with block). Sessions idle
+    for too long are closed, others are verified before being reused.
+    Broken sessions are closed, and the sessions with the same credentials
+    are always verified until one of them is found healthy
+    """
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.pid = os.getpid()
+        # released sessions with their release time, the last one on top
+        self.idle: Dict[PoolKey, List[Tuple[float, IrodsPythonExt]]] = {}
+        # credentials of the sessions that failed since the last verification
+        self.failed: Set[PoolKey] = set()
+
+    @staticmethod
+    def get_key(variables: Dict[str, Any]) -> PoolKey:
+        # the password is part of the key: a session is never reused with
+        # credentials different from the ones that it verified
+        password = str(variables.get("password") or "")
+        return (
+            str(variables.get("user")),
+            str(variables.get("zone")),
+            str(variables.get("authscheme", NORMAL_AUTH_SCHEME)),
+            str(variables.get("host")),
+            str(variables.get("port")),
+            hashlib.sha256(password.encode()).hexdigest(),
+        )
+
+    def check_fork(self) -> None:
+        # sessions inherited from the parent process share its sockets
+        if os.getpid() != self.pid:
+            self.idle = {}
+            self.failed = set()
+            self.pid = os.getpid()
+
+    def checkout(
+        self,
+        verification: Optional[int] = None,
+        expiration: Optional[int] = None,
+        **kwargs: str,
+    ) -> IrodsPythonExt:
+
+        variables = instance.variables.copy()
+        variables.update(kwargs)
+        key = self.get_key(variables)
+        max_idle = Env.to_int(variables.get("pool_max_idle"), DEFAULT_POOL_MAX_IDLE)
+        if verification is None:
+            verification = Env.to_int(
+                variables.get("pool_verification"), DEFAULT_POOL_VERIFICATION
+            )
+        if expiration is None:
+            expiration = Env.to_int(variables.get("expiration_time"), 0)
+
+        while True:
+            with self.lock:
+                self.check_fork()
+                sessions = self.idle.get(key)
+                if not sessions:
+                    break
+                released_at, obj = sessions.pop()
+                verify = key in self.failed
+
+            now = time.monotonic()
+            if now - released_at > max_idle or (
+                expiration and now - obj.created_at > expiration
+            ):
+                obj.close()
+                continue
+            if verify or now - released_at > verification:
+                if not obj.is_healthy():
+                    obj.close()
+                    continue
+                with self.lock:
+                    self.failed.discard(key)
+
+            obj.disconnected = False
+            obj.pool_key = key
+            return obj
+
+        obj = IrodsPythonExt()
+        obj.connect(**kwargs)
+        obj.disconnected = False
+        obj.pool_key = key
+        log.debug("New iRODS session for {}", key[0])
+        return obj
+
+    def release(self, obj: IrodsPythonExt, broken: bool = False) -> None:
+
+        key = obj.pool_key
+        obj.pool_key = None
+        max_size = Env.to_int(
+            instance.variables.get("pool_max_size"), DEFAULT_POOL_MAX_SIZE
+        )
+        with self.lock:
+            self.check_fork()
+            if broken:
+                if key:
+                    self.failed.add(key)
+                log.debug("Closing the iRODS session released after a failure")
+            sessions = self.idle.setdefault(key, []) if key else []
+            if key and not broken and obj.ticket is None and len(sessions) < max_size:
+                sessions.append((time.monotonic(), obj))
+                return
+        obj.close()
+
+    def clear(self) -> None:
+        with self.lock:
+            sessions = [obj for idle in self.idle.values() for _, obj in idle]
+            self.idle = {}
+            self.failed = set()
+        for obj in sessions:
+            obj.close()
+
+
+pool = SessionPool()
+
 
 def get_instance(
     verification: Optional[int] = None,
@@ -609,6 +1195,10 @@ def get_instance(
     **kwargs: str,
 ) -> "IrodsPythonExt":
 
-    return instance.get_instance(
-        verification=verification, expiration=expiration, **kwargs
-    )
+    # within requests the instances are already cached by the connector
+    if has_request_context():
+        return instance.get_instance(
+            verification=verification, expiration=expiration, **kwargs
+        )
+
+    return pool.checkout(verification=verification, expiration=expiration, **kwargs)
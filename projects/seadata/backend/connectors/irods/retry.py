@@ -0,0 +1,182 @@
+"""
+Retry policy of the iRODS operations: exponential backoff with jitter for
+transient errors and a circuit breaker to fail fast while B2SAFE is down
+"""
+import random
+import time
+from functools import wraps
+from threading import Lock
+from typing import Any, Callable, Dict, Optional, Tuple, Type, TypeVar, cast
+
+from irods import exception as iexceptions
+from restapi.exceptions import ServiceUnavailable
+from restapi.utilities.logs import log
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+RETRY_ATTEMPTS = 5
+# Seconds, the delay before the n-th retry is random in [0, base * 2^(n-1)]
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 120.0
+# Consecutive transient failures that open the circuit
+BREAKER_THRESHOLD = 10
+# Seconds before a call is attempted again once the circuit is open
+BREAKER_RESET_TIMEOUT = 60.0
+
+# Connection problems, worth a retry. Other errors (e.g. missing objects,
+# permissions, duplicated metadata) would fail again and are raised at once
+RETRYABLE_ERRORS: Tuple[Type[BaseException], ...] = tuple(
+    getattr(iexceptions, name)
+    for name in (
+        "NetworkException",
+        "SYS_SOCK_READ_ERR",
+        "SYS_SOCK_READ_TIMEDOUT",
+        "SYS_HEADER_READ_LEN_ERR",
+        "SYS_HEADER_WRITE_LEN_ERR",
+        "SYS_SOCK_CONNECT_ERR",
+        "CAT_SQL_ERR",
+    )
+    if hasattr(iexceptions, name)
+) + (ConnectionError, EOFError)
+
+
+class CircuitOpen(ServiceUnavailable):
+    """B2SAFE failed too many times in a row, calls are not even attempted"""
+
+
+class RetryMetrics:
+    """Calls, attempts, failures and time spent for each operation"""
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.operations: Dict[str, Dict[str, float]] = {}
+
+    def record(self, name: str, attempts: int, failed: bool, elapsed: float) -> None:
+        with self.lock:
+            stats = self.operations.setdefault(
+                name, {"calls": 0, "attempts": 0, "failures": 0, "seconds": 0.0}
+            )
+            stats["calls"] += 1
+            stats["attempts"] += attempts
+            stats["failures"] += int(failed)
+            stats["seconds"] += elapsed
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self.lock:
+            return {name: dict(stats) for name, stats in self.operations.items()}
+
+
+class CircuitBreaker:
+    """
+    Opened after `threshold` consecutive transient failures, every call
+    then fails with CircuitOpen until reset_timeout seconds have passed
+    """
+
+    def __init__(
+        self,
+        threshold: int = BREAKER_THRESHOLD,
+        reset_timeout: float = BREAKER_RESET_TIMEOUT,
+    ) -> None:
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = Lock()
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    def check(self) -> None:
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpen("B2SAFE is temporarily unavailable")
+            # half open: let the next call test the service
+            self.opened_at = None
+
+    def success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold and self.opened_at is None:
+                log.error(
+                    "B2SAFE failed {} times in a row, circuit open", self.failures
+                )
+                self.opened_at = time.monotonic()
+
+
+class RetryPolicy:
+    """
+    Retry transient errors with exponential backoff and full jitter,
+    raising fatal errors at once. Can be used as a decorator
+    """
+
+    def __init__(
+        self,
+        attempts: int = RETRY_ATTEMPTS,
+        base_delay: float = RETRY_BASE_DELAY,
+        max_delay: float = RETRY_MAX_DELAY,
+        breaker: Optional[CircuitBreaker] = None,
+        metrics: Optional[RetryMetrics] = None,
+    ) -> None:
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = metrics or RetryMetrics()
+
+    @staticmethod
+    def is_retryable(error: BaseException) -> bool:
+        return isinstance(error, RETRYABLE_ERRORS)
+
+    def get_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def call(
+        self, name: str, func: Callable[..., Any], *args: Any, **kwargs: Any
+    ) -> Any:
+        start = time.monotonic()
+        attempt = 0
+        try:
+            while True:
+                attempt += 1
+                self.breaker.check()
+                try:
+                    output = func(*args, **kwargs)
+                except BaseException as e:
+                    if not self.is_retryable(e):
+                        raise
+                    self.breaker.failure()
+                    if attempt >= self.attempts:
+                        raise
+                    delay = self.get_delay(attempt - 1)
+                    log.warning(
+                        "{} failed ({}: {}), retry {}/{} in {:.1f}s",
+                        name,
+                        e.__class__.__name__,
+                        e,
+                        attempt,
+                        self.attempts - 1,
+                        delay,
+                    )
+                    time.sleep(delay)
+                else:
+                    self.breaker.success()
+                    self.metrics.record(name, attempt, False, time.monotonic() - start)
+                    return output
+        except BaseException:
+            self.metrics.record(name, attempt, True, time.monotonic() - start)
+            raise
+
+    def __call__(self, func: F) -> F:
+        @wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            return self.call(func.__name__, func, *args, **kwargs)
+
+        return cast(F, wrapper)
+
+
+# Shared by all the sessions of the process: B2SAFE is either up or down
+retry_policy = RetryPolicy()
@@ -0,0 +1,289 @@
+"""
+Concurrent transfers of data objects over a pool of iRODS sessions
+"""
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from restapi.utilities.logs import log
+from seadata.connectors.irods import IrodsException, IrodsPythonExt, get_instance
+
+T = TypeVar("T")
+
+DEFAULT_WORKERS = 4
+DEFAULT_RETRIES = 3
+RETRY_WAIT = 5
+
+# (key, irods path, transfer output, raised exception)
+TransferResult = Tuple[str, Path, Optional[T], Optional[BaseException]]
+
+# Receives a batch of items and returns, for each of them, None if the item
+# can be passed to the next stage or a failure (e.g. an error code)
+StageHandler = Callable[[IrodsPythonExt, List[Any]], List[Optional[Any]]]
+# (item, name of the failed stage or None if completed, failure)
+PipelineResult = Tuple[Any, Optional[str], Optional[Any]]
+
+DEFAULT_QUEUE_SIZE = 16
+
+
+class SessionsQueue:
+    """
+    Thread-safe set of iRODS sessions, checked out from the process pool on
+    demand and shared by the workers of a parallel transfer
+    """
+
+    def __init__(self) -> None:
+        self.idle: "Queue[IrodsPythonExt]" = Queue()
+        self.opened: List[IrodsPythonExt] = []
+        self.lock = Lock()
+
+    def checkout(self) -> IrodsPythonExt:
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            imain = get_instance()
+            with self.lock:
+                self.opened.append(imain)
+            return imain
+
+    def release(self, imain: IrodsPythonExt, broken: bool = False) -> None:
+        if not broken:
+            self.idle.put(imain)
+            return
+
+        # A failed session is never reused, a new one will be opened if needed
+        with self.lock:
+            self.opened.remove(imain)
+        imain.close()
+
+    def close(self) -> None:
+        with self.lock:
+            for imain in self.opened:
+                imain.disconnect()
+            self.opened.clear()
+
+
+def parallel_fetch(
+    files: Mapping[str, Path],
+    transfer: Callable[[IrodsPythonExt, str, Path], T],
+    workers: int = DEFAULT_WORKERS,
+    retries: int = DEFAULT_RETRIES,
+) -> Iterator[TransferResult[T]]:
+    """
+    Apply the transfer function to every (key, irods path) in files, running
+    up to `workers` transfers at once, each one on its own iRODS session.
+    Every file is retried separately up to `retries` times; IrodsExceptions
+    (e.g. object not found or no permissions) are not retried.
+    Results are yielded as soon as they complete, in the caller thread,
+    and no more than 2 x workers results are pending at any time.
+    """
+
+    sessions = SessionsQueue()
+
+    def run(key: str, ipath: Path) -> T:
+        attempt = 1
+        while True:
+            imain = sessions.checkout()
+            try:
+                output = transfer(imain, key, ipath)
+            except IrodsException:
+                sessions.release(imain)
+                raise
+            except BaseException as e:
+                sessions.release(imain, broken=True)
+                if attempt >= retries:
+                    raise e
+                log.warning(
+                    "Transfer of {} failed ({}), retry {}/{}",
+                    ipath,
+                    e,
+                    attempt,
+                    retries - 1,
+                )
+                attempt += 1
+                time.sleep(RETRY_WAIT)
+            else:
+                sessions.release(imain)
+                return output
+
+    pending: Dict["Future[T]", Tuple[str, Path]] = {}
+    items = iter(files.items())
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            while len(pending) < 2 * workers:
+                try:
+                    key, ipath = next(items)
+                except StopIteration:
+                    break
+                pending[executor.submit(run, key, ipath)] = (key, ipath)
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, ipath = pending.pop(future)
+                error = future.exception()
+                if error is not None:
+                    yield key, ipath, None, error
+                else:
+                    yield key, ipath, future.result(), None
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        sessions.close()
+
+
+class Stage:
+    """
+    A step of a pipeline, executed by `workers` threads with their own
+    iRODS session. Up to batch_size items already waiting in the stage queue
+    are passed to the handler at once
+    """
+
+    def __init__(
+        self, name: str, handler: StageHandler, workers: int = 1, batch_size: int = 1
+    ) -> None:
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+
+
+def run_pipeline(
+    items: Iterable[Any],
+    stages: List[Stage],
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+) -> Iterator[PipelineResult]:
+    """
+    Pass every item through the stages in order, all stages running at once:
+    item N+1 is processed by the first stage while item N is in the second.
+    Stages are connected by bounded queues, a slow stage stops the previous
+    ones when its queue is full. Items failed in a stage do not proceed.
+    If a handler raises, or does not return one failure for each item,
+    the exception is the failure of all its batch.
+    Results are yielded in the caller thread as soon as items complete or fail,
+    an exception raised by the items iterable is raised once they are all done
+    """
+
+    stop = object()
+    queues: List["Queue[Any]"] = [Queue(maxsize=queue_size) for _ in stages]
+    results: "Queue[Any]" = Queue()
+    sessions = SessionsQueue()
+    aborted = Event()
+    lock = Lock()
+    running = [stage.workers for stage in stages]
+    feed_errors: List[BaseException] = []
+
+    def forward(index: int, item: Any) -> None:
+        if index + 1 < len(stages):
+            queues[index + 1].put(item)
+        elif item is not stop:
+            results.put((item, None, None))
+
+    def work(index: int) -> None:
+        stage = stages[index]
+        inbox = queues[index]
+        imain: Optional[IrodsPythonExt] = None
+        while True:
+            batch = [inbox.get()]
+            while batch[-1] is not stop and len(batch) < stage.batch_size:
+                try:
+                    batch.append(inbox.get_nowait())
+                except Empty:
+                    break
+
+            done = batch[-1] is stop
+            if done:
+                batch.pop()
+                # let the other workers of the stage know
+                inbox.put(stop)
+
+            if batch and not aborted.is_set():
+                try:
+                    imain = imain or sessions.checkout()
+                    failures = stage.handler(imain, batch)
+                except BaseException as e:
+                    log.error("{} failed for {} items: {}", stage.name, len(batch), e)
+                    if imain:
+                        sessions.release(imain, broken=True)
+                        imain = None
+                    failures = [e] * len(batch)
+
+                if len(failures) != len(batch):
+                    error = ValueError(
+                        f"{len(failures)} results for {len(batch)} items"
+                    )
+                    log.error("{} failed: {}", stage.name, error)
+                    failures = [error] * len(batch)
+
+                for item, failure in zip(batch, failures):
+                    if failure is None:
+                        forward(index, item)
+                    else:
+                        results.put((item, stage.name, failure))
+
+            if done:
+                break
+
+        if imain:
+            sessions.release(imain)
+        with lock:
+            running[index] -= 1
+            last = running[index] == 0
+        if last:
+            if index + 1 < len(stages):
+                forward(index, stop)
+            else:
+                results.put(stop)
+
+    def feed() -> None:
+        try:
+            for item in items:
+                if aborted.is_set():
+                    break
+                queues[0].put(item)
+        except BaseException as e:
+            log.error("Pipeline input failed: {}", e)
+            feed_errors.append(e)
+        finally:
+            # the workers wait for it, even if the input failed
+            queues[0].put(stop)
+
+    threads = [Thread(target=feed, daemon=True)]
+    for index, stage in enumerate(stages):
+        threads.extend(
+            Thread(target=work, args=(index,), daemon=True)
+            for _ in range(stage.workers)
+        )
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            result = results.get()
+            if result is stop:
+                break
+            yield result
+        if feed_errors:
+            raise feed_errors[0]
+    finally:
+        # pending items are discarded, workers are left to drain the queues
+        aborted.set()
+        for thread in threads:
+            thread.join()
+        sessions.close()
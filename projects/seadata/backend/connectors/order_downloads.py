@@ -0,0 +1,127 @@
+"""
+Redis index of the download links of the orders: ticket code, url and size
+of each zip file, so that downloads and listings do not have to read the
+iRODS metadata of the zip files.
+The codes of the issued tickets are also kept, to be revoked once expired.
+Size and modification time of the zip files kept on the local mount are
+recorded when they are uploaded, to serve them only while unchanged
+"""
+
+import json
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+RedisClient = Any
+
+ORDER_PREFIX = "order:downloads:"
+LOCAL_PREFIX = "order:local:"
+# Codes of the issued tickets, scored by expiration time
+TICKETS_KEY = "order:tickets"
+SWEEP_LOCK_KEY = "order:tickets:sweep"
+
+
+class OrderDownloads:
+    def __init__(self, r: RedisClient, ttl: int) -> None:
+        self.r = r
+        self.ttl = ttl
+
+    @staticmethod
+    def get_key(order_id: str) -> str:
+        return f"{ORDER_PREFIX}{order_id}"
+
+    @staticmethod
+    def is_valid(entry: Dict[str, Any]) -> bool:
+        return float(entry.get("expires", 0)) > time.time()
+
+    def get(self, order_id: str, zip_name: str) -> Optional[Dict[str, Any]]:
+        """The download link of a zip file, if any and not expired"""
+
+        value = self.r.hget(self.get_key(order_id), zip_name)
+        if value is None:
+            return None
+        entry: Dict[str, Any] = json.loads(value)
+        return entry if self.is_valid(entry) else None
+
+    def get_all(self, order_id: str) -> Dict[str, Dict[str, Any]]:
+        """The download links of all the zip files of an order"""
+
+        entries = (
+            (k.decode(), json.loads(v))
+            for k, v in self.r.hgetall(self.get_key(order_id)).items()
+        )
+        return {name: entry for name, entry in entries if self.is_valid(entry)}
+
+    def get_reusable(self, order_id: str, zip_name: str) -> Optional[Dict[str, Any]]:
+        """The download link of a zip file, if valid for at least half its ttl"""
+
+        entry = self.get(order_id, zip_name)
+        if entry is None:
+            return None
+        if float(entry["expires"]) - time.time() < self.ttl / 2:
+            return None
+        return entry
+
+    def get_expiration(self) -> int:
+        """Expiration time of the links created now"""
+        return int(time.time()) + self.ttl
+
+    def set(
+        self,
+        order_id: str,
+        zip_name: str,
+        code: str,
+        url: str,
+        size: int,
+        expires: Optional[int] = None,
+    ) -> None:
+        entry = {
+            "code": code,
+            "url": url,
+            "size": size,
+            "expires": expires or self.get_expiration(),
+        }
+        key = self.get_key(order_id)
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hset(key, zip_name, json.dumps(entry))
+        pipe.zadd(TICKETS_KEY, {code: entry["expires"]})
+        # the links are renewed together, so they share the order expiration
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def delete(self, order_id: str) -> None:
+        self.r.delete(self.get_key(order_id), f"{LOCAL_PREFIX}{order_id}")
+
+    def set_local_copy(self, order_id: str, local_zip: Path) -> None:
+        """Record the zip file uploaded to iRODS from the local mount"""
+
+        stat = local_zip.stat()
+        entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+        self.r.hset(f"{LOCAL_PREFIX}{order_id}", local_zip.name, json.dumps(entry))
+
+    def get_local_copy(self, order_id: str, zip_name: str) -> Optional[Dict[str, Any]]:
+        value = self.r.hget(f"{LOCAL_PREFIX}{order_id}", zip_name)
+        if value is None:
+            return None
+        entry: Dict[str, Any] = json.loads(value)
+        return entry
+
+    def forget(self, order_id: str, zip_name: str) -> None:
+        """Drop link and local copy of a zip file replaced or moved on iRODS"""
+
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hdel(self.get_key(order_id), zip_name)
+        pipe.hdel(f"{LOCAL_PREFIX}{order_id}", zip_name)
+        pipe.execute()
+
+    def get_expired_tickets(self) -> List[str]:
+        codes = self.r.zrangebyscore(TICKETS_KEY, "-inf", time.time())
+        return [code.decode() for code in codes]
+
+    def forget_tickets(self, codes: List[str]) -> None:
+        if codes:
+            self.r.zrem(TICKETS_KEY, *codes)
+
+    def should_sweep(self, interval: int) -> bool:
+        """True at most once every interval seconds, among all the processes"""
+        return bool(self.r.set(SWEEP_LOCK_KEY, 1, nx=True, ex=interval))
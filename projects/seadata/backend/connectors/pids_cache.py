@@ -0,0 +1,262 @@
+"""
+Redis cache of the PIDs assigned to the production files.
+All the PIDs are kept in a single hash (PID -> path), each production batch
+also has its own hash with the PIDs of its files, so that a batch can be
+counted or invalidated without scanning the keyspace.
+The number of PIDs for each prefix is updated on every write
+"""
+
+import json
+import re
+import time
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+RedisClient = Any
+
+# Max number of fields sent with a single HMGET/HSET command
+REDIS_CHUNK_SIZE = 1000
+
+PIDS_KEY = "pids"
+BATCH_PREFIX = "batch:"
+# Number of cached PIDs for each prefix and names of the cached batches
+PREFIXES_KEY = "pids:prefixes"
+BATCHES_KEY = "pids:batches"
+# Resolved PIDs (path and metadata of the referenced object)
+RESOLVED_PREFIX = "pids:resolved:"
+# Handle PIDs (e.g. 21.T12995/abc), the only keys migrated by the audit
+LEGACY_PID = re.compile(rb"^\d+(\.\w+)*/")
+
+
+def chunks(keys: List[str], size: int = REDIS_CHUNK_SIZE) -> Iterable[List[str]]:
+    for i in range(0, len(keys), size):
+        yield keys[i : i + size]
+
+
+class PIDCache:
+    def __init__(self, r: RedisClient) -> None:
+        self.r = r
+
+    @staticmethod
+    def get_batch_id(path: Union[str, Path]) -> str:
+        """Production files are stored in a collection named as their batch"""
+        return Path(path).parent.name
+
+    @staticmethod
+    def get_batch_key(batch_id: str) -> str:
+        return f"{BATCH_PREFIX}{batch_id}"
+
+    @staticmethod
+    def get_prefix(pid: str) -> str:
+        return pid.split("/")[0]
+
+    def lookup(self, pids: Iterable[str]) -> Dict[str, str]:
+        """Paths of the cached PIDs, with a pipelined HMGET for each chunk"""
+
+        unique_pids = list(dict.fromkeys(pids))
+        pipe = self.r.pipeline(transaction=False)
+        for chunk in chunks(unique_pids):
+            pipe.hmget(PIDS_KEY, chunk)
+        values = [v for chunk in pipe.execute() for v in chunk]
+
+        paths: Dict[str, str] = {}
+        misses: List[str] = []
+        for pid, value in zip(unique_pids, values):
+            if value is None:
+                misses.append(pid)
+            else:
+                paths[pid] = value.decode()
+
+        if misses:
+            # PIDs cached as plain keys before the introduction of the hashes
+            pipe = self.r.pipeline(transaction=False)
+            for chunk in chunks(misses):
+                pipe.mget(chunk)
+            values = [v for chunk in pipe.execute() for v in chunk]
+            for pid, value in zip(misses, values):
+                if value is not None:
+                    paths[pid] = value.decode()
+
+        return paths
+
+    def get(self, pid: str) -> Optional[str]:
+        return self.lookup([pid]).get(pid)
+
+    def store(self, mapping: Dict[str, str]) -> int:
+        """
+        Cache PID -> path pairs and update the counters of the new PIDs,
+        with two pipelines. Returns the number of PIDs not cached before
+        """
+
+        pids = list(mapping)
+        pipe = self.r.pipeline(transaction=False)
+        for pid in pids:
+            path = str(mapping[pid])
+            pipe.hset(PIDS_KEY, pid, path)
+            pipe.hset(self.get_batch_key(self.get_batch_id(path)), pid, path)
+        created = pipe.execute()[::2]
+
+        # HSET reports the new fields, so concurrent writers never count twice
+        prefixes: Dict[str, int] = {}
+        batches = set()
+        for pid, new in zip(pids, created):
+            if new:
+                prefix = self.get_prefix(pid)
+                prefixes[prefix] = prefixes.get(prefix, 0) + 1
+                batches.add(self.get_batch_id(mapping[pid]))
+
+        if prefixes:
+            pipe = self.r.pipeline(transaction=False)
+            for prefix, counter in prefixes.items():
+                pipe.hincrby(PREFIXES_KEY, prefix, counter)
+            pipe.sadd(BATCHES_KEY, *batches)
+            pipe.execute()
+        return sum(prefixes.values())
+
+    def count(self, batch_id: Optional[str] = None) -> int:
+        """Number of PIDs cached, in total or for a batch"""
+        if batch_id is None:
+            return int(self.r.hlen(PIDS_KEY))
+        return int(self.r.hlen(self.get_batch_key(batch_id)))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Cached PIDs in total, for each prefix and for each batch"""
+
+        batches = sorted(b.decode() for b in self.r.smembers(BATCHES_KEY))
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hlen(PIDS_KEY)
+        pipe.hgetall(PREFIXES_KEY)
+        for batch_id in batches:
+            pipe.hlen(self.get_batch_key(batch_id))
+        total, prefixes, *counters = pipe.execute()
+        return {
+            "total": int(total),
+            "prefixes": {k.decode(): int(v) for k, v in prefixes.items()},
+            "batches": {b: int(c) for b, c in zip(batches, counters) if c},
+        }
+
+    def audit(self, page_size: int = REDIS_CHUNK_SIZE) -> Dict[str, Any]:
+        """
+        Count the cached PIDs by prefix and folder reading the whole cache.
+        The plain keys written by older versions are first migrated into the
+        hashes, with a pipelined MGET for each page of keys, then the prefix
+        counters are rebuilt from the hashes
+        """
+
+        legacy = 0
+        cursor = None
+        while cursor != 0:
+            cursor, keys = self.r.scan(cursor=cursor or 0, count=page_size)
+            keys = [k for k in keys if LEGACY_PID.match(k)]
+            if not keys:
+                continue
+            pipe = self.r.pipeline(transaction=False)
+            pipe.mget(keys)
+            pipe.hmget(PIDS_KEY, keys)
+            values, hashed = pipe.execute()
+            mapping = {
+                key.decode(): value.decode()
+                for key, value, cached in zip(keys, values, hashed)
+                # values of other types are returned as None by MGET,
+                # only absolute iRODS paths are values of the legacy PIDs
+                if value is not None and value.startswith(b"/") and cached is None
+            }
+            if mapping:
+                legacy += self.store(mapping)
+
+        prefixes: Dict[str, int] = {}
+        folders: Dict[str, int] = {}
+        for pid, path in self.r.hscan_iter(PIDS_KEY, count=page_size):
+            prefix = self.get_prefix(pid.decode())
+            prefixes[prefix] = prefixes.get(prefix, 0) + 1
+            folder = str(Path(path.decode()).parent)
+            folders[folder] = folders.get(folder, 0) + 1
+
+        pipe = self.r.pipeline(transaction=False)
+        pipe.delete(PREFIXES_KEY)
+        if prefixes:
+            pipe.hset(PREFIXES_KEY, mapping=prefixes)
+        pipe.execute()
+
+        return {
+            "total": sum(prefixes.values()),
+            "legacy": legacy,
+            "prefixes": prefixes,
+            "folders": folders,
+        }
+
+    def invalidate(self, batch_id: str) -> int:
+        """Remove the PIDs of a batch from the cache, returns how many"""
+
+        key = self.get_batch_key(batch_id)
+        batch = {k.decode(): v.decode() for k, v in self.r.hgetall(key).items()}
+        pids = list(batch)
+        pipe = self.r.pipeline(transaction=False)
+        for pid in pids:
+            pipe.hdel(PIDS_KEY, pid)
+        deleted = pipe.execute()
+
+        prefixes: Dict[str, int] = {}
+        for pid, removed in zip(pids, deleted):
+            if removed:
+                prefix = self.get_prefix(pid)
+                prefixes[prefix] = prefixes.get(prefix, 0) + 1
+
+        pipe = self.r.pipeline(transaction=False)
+        for prefix, counter in prefixes.items():
+            pipe.hincrby(PREFIXES_KEY, prefix, -counter)
+        for chunk in chunks(pids):
+            # plain keys written before the introduction of the hashes
+            pipe.delete(*chunk, *[batch[pid] for pid in chunk])
+        pipe.delete(key)
+        pipe.srem(BATCHES_KEY, batch_id)
+        pipe.execute()
+        return len(pids)
+
+
+class ResolvedPIDCache:
+    """
+    Read-through cache of the resolved PIDs, kept both in redis (shared by
+    all the processes) and in a small in-process LRU, both expiring after ttl
+    seconds. Entries are cached as they are, PIDs not found are never cached
+    """
+
+    def __init__(self, ttl: int, max_size: int = 10000) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = Lock()
+        self.local: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+    def get(self, r: RedisClient, pid: str) -> Optional[Dict[str, Any]]:
+
+        with self.lock:
+            entry = self.local.get(pid)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.local.move_to_end(pid)
+                    return entry[1]
+                del self.local[pid]
+
+        pipe = r.pipeline(transaction=False)
+        pipe.get(f"{RESOLVED_PREFIX}{pid}")
+        pipe.ttl(f"{RESOLVED_PREFIX}{pid}")
+        value, ttl = pipe.execute()
+        if value is None:
+            return None
+        data: Dict[str, Any] = json.loads(value)
+        # do not keep it locally longer than in redis
+        self.set_local(pid, data, min(self.ttl, ttl) if ttl > 0 else self.ttl)
+        return data
+
+    def set(self, r: RedisClient, pid: str, data: Dict[str, Any]) -> None:
+        r.setex(f"{RESOLVED_PREFIX}{pid}", self.ttl, json.dumps(data))
+        self.set_local(pid, data, self.ttl)
+
+    def set_local(self, pid: str, data: Dict[str, Any], ttl: int) -> None:
+        with self.lock:
+            self.local[pid] = (time.monotonic() + ttl, data)
+            self.local.move_to_end(pid)
+            while len(self.local) > self.max_size:
+                self.local.popitem(last=False)
@@ -43,6 +43,20 @@
 """
 INGESTION_DIR = seadata_vars.get("workspace_ingestion") or "batches"
 ORDERS_DIR = seadata_vars.get("workspace_orders") or "orders"
+# Parts of the restricted zip of an order, saved together with the parts
+RESTRICTED_MANIFEST = "restricted_manifest.json"
+# Seconds the download links of an order are valid
+ORDER_DOWNLOAD_TTL = Env.to_int(seadata_vars.get("order_download_ttl"), 172800)
+# Also save the download links as metadata of the zip files in iRODS
+ORDER_AVU_MIRROR = Env.to_bool(seadata_vars.get("order_avu_mirror"), True)
+# How order zips still available on the local mount are downloaded:
+# irods (always streamed from iRODS), sendfile (served by the backend with
+# send_file) or x-accel (served by the proxy through X-Accel-Redirect)
+ORDER_DOWNLOAD_MODE = seadata_vars.get("order_download_mode") or "irods"
+# Internal location of the proxy mapped on the local orders directory
+ORDER_ACCEL_PREFIX = seadata_vars.get("order_accel_prefix") or "/protected_orders/"
+# Seconds a resolved PID (path and metadata) is cached
+PID_RESOLUTION_TTL = Env.to_int(seadata_vars.get("pid_resolution_ttl"), 600)
 
 """
 These are how the paths to the data on the host
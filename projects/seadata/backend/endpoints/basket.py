@@ -18,30 +18,41 @@
 
 #################
 # IMPORTS
+import re
 import urllib.parse
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import requests
+from flask import Response as FlaskResponse
+from flask import request, send_file
 from irods.exception import NetworkException
 from restapi import decorators
 from restapi.config import get_backend_url
-from restapi.connectors import celery
+from restapi.connectors import celery, redis
 from restapi.exceptions import BadRequest, NotFound, ServiceUnavailable
 from restapi.rest.definition import Response
 from restapi.services.authentication import User
 from restapi.utilities.logs import log
 from seadata.connectors import irods
+from seadata.connectors.order_downloads import OrderDownloads
 from seadata.connectors.rabbit_queue import log_into_queue, prepare_message
 from seadata.endpoints import (
     MOUNTPOINT,
+    ORDER_ACCEL_PREFIX,
+    ORDER_AVU_MIRROR,
+    ORDER_DOWNLOAD_MODE,
+    ORDER_DOWNLOAD_TTL,
     ORDERS_COLL,
     ORDERS_DIR,
+    RESTRICTED_MANIFEST,
     EndpointsInputSchema,
     SeaDataEndpoint,
 )
 
 TMPDIR = "/tmp"
+# Seconds between two revocations of the expired tickets
+TICKET_SWEEP_INTERVAL = 3600
 
 
 def get_order_zip_file_name(
@@ -57,6 +68,36 @@ def get_order_zip_file_name(
     return zip_file_name
 
 
+def get_order_zip_parts(
+    order_id: str, files: Dict[str, Any]
+) -> List[Tuple[bool, Optional[int]]]:
+    """
+    The zip files of an order as (restricted, index), unrestricted first.
+    If a zip is split its parts are returned sorted by index,
+    the unsplit file (index None) is skipped
+    """
+
+    pattern = re.compile(
+        rf"^order_{re.escape(order_id)}_(unrestricted|restricted)(\d*)\.zip$"
+    )
+    found: Dict[bool, List[Optional[int]]] = {False: [], True: []}
+    for name in files:
+        match = pattern.match(name)
+        if match:
+            label, index = match.groups()
+            found[label == "restricted"].append(int(index) if index else None)
+
+    parts: List[Tuple[bool, Optional[int]]] = []
+    for restricted in (False, True):
+        indexes = found[restricted]
+        if 1 in indexes:
+            split = sorted(i for i in indexes if i is not None and i >= 1)
+            parts.extend((restricted, index) for index in split)
+        elif None in indexes:
+            parts.append((restricted, None))
+    return parts
+
+
 #################
 # REST CLASSES
 class DownloadBasketEndpoint(SeaDataEndpoint):
@@ -84,6 +125,59 @@ def get_filename_from_type(self, order_id: str, ftype: str) -> Optional[str]:
 
         return get_order_zip_file_name(order_id, restricted=restricted, index=index)
 
+    def get_local_copy(
+        self,
+        downloads: OrderDownloads,
+        order_id: str,
+        zip_file_name: str,
+        entry: Optional[Dict[str, Any]],
+    ) -> Optional[Path]:
+        """
+        The zip file on the local mount, if still there and unchanged since
+        its upload to iRODS (same size and modification time)
+        """
+
+        if ORDER_DOWNLOAD_MODE == "irods" or entry is None:
+            return None
+
+        uploaded = downloads.get_local_copy(order_id, zip_file_name)
+        if uploaded is None or uploaded["size"] != entry.get("size"):
+            return None
+
+        local_zip = MOUNTPOINT.joinpath(ORDERS_DIR, order_id, zip_file_name)
+        try:
+            stat = local_zip.stat()
+        except OSError:
+            return None
+
+        if (stat.st_size, stat.st_mtime_ns) != (uploaded["size"], uploaded["mtime"]):
+            log.info("Local copy of {} differs from iRODS, not used", zip_file_name)
+            return None
+        return local_zip
+
+    def send_local_copy(
+        self, local_zip: Path, zip_file_name: str, headers: Dict[str, str]
+    ) -> Response:
+        """Serve a zip from the local mount, without reading it in python"""
+
+        if ORDER_DOWNLOAD_MODE == "x-accel":
+            relative = local_zip.relative_to(MOUNTPOINT.joinpath(ORDERS_DIR))
+            headers["X-Accel-Redirect"] = f"{ORDER_ACCEL_PREFIX}{relative}"
+            headers["Content-Type"] = "application/zip"
+            log.debug("Download of {} redirected to the proxy", local_zip)
+            return FlaskResponse(headers=headers)
+
+        # sent with os.sendfile by the wsgi server (or X-Sendfile if enabled
+        # with USE_X_SENDFILE), with support of ranges and conditional requests
+        log.debug("Sending local copy {}", local_zip)
+        return send_file(
+            local_zip,
+            mimetype="application/zip",
+            as_attachment=True,
+            download_name=zip_file_name,
+            conditional=True,
+        )
+
     @decorators.endpoint(
         path="/orders/<order_id>/download/<ftype>/c/<code>",
         summary="Download an order",
@@ -114,16 +208,23 @@ def get(self, order_id: str, ftype: str, code: str) -> Response:
 
             error = f"Order '{order_id}' not found (or no permissions)"
 
-            log.debug("Checking zip irods path: {}", zip_ipath)
-            if not imain.is_dataobject(zip_ipath):
-                log.error("File not found {}", zip_ipath)
+            downloads = OrderDownloads(redis.get_instance().r, ORDER_DOWNLOAD_TTL)
+            entry = downloads.get(order_id, zip_file_name)
+            if entry is not None:
+                iticket_code = entry["code"]
+            elif ORDER_AVU_MIRROR:
+                # links not indexed (e.g. created by previous versions)
+                log.debug("Checking zip irods path: {}", zip_ipath)
+                if not imain.is_dataobject(zip_ipath):
+                    log.error("File not found {}", zip_ipath)
+                    raise NotFound(error)
+
+                metadata = imain.get_metadata(zip_ipath)
+                iticket_code = metadata.get("iticket_code")
+            else:
+                log.error("No download link for {}", zip_ipath)
                 raise NotFound(error)
 
-            # TOFIX: we should use a database or cache to save this,
-            # not irods metadata (known for low performances)
-            metadata = imain.get_metadata(zip_ipath)
-            iticket_code = metadata.get("iticket_code")
-
             encoded_code = urllib.parse.quote_plus(code)
 
             if iticket_code != encoded_code:
@@ -157,7 +258,14 @@ def get(self, order_id: str, ftype: str, code: str) -> Response:
             }
             msg = prepare_message(self, json=json, log_string="end", status="sent")
             log_into_queue(self, msg)
-            return icom.stream_ticket(zip_ipath, headers=headers)
+
+            local_zip = self.get_local_copy(downloads, order_id, zip_file_name, entry)
+            if local_zip is not None:
+                return self.send_local_copy(local_zip, zip_file_name, headers)
+
+            return icom.stream_ticket(
+                zip_ipath, headers=headers, request_headers=request.headers
+            )
         except requests.exceptions.ReadTimeout:  # pragma: no cover
             raise ServiceUnavailable("B2SAFE is temporarily unavailable")
 
@@ -202,6 +310,8 @@ def get(self, order_id: str, user: User) -> Response:
                 ils.pop(r, None)
 
             response = []
+            downloads = OrderDownloads(redis.get_instance().r, ORDER_DOWNLOAD_TTL)
+            links = downloads.get_all(order_id)
 
             for _, data in ils.items():
                 name = data.get("name")
@@ -212,14 +322,21 @@ def get(self, order_id: str, user: User) -> Response:
                 if name.endswith(".bak"):
                     continue
 
+                if name == RESTRICTED_MANIFEST:
+                    continue
+
                 path = data.get("path")
                 if not path:  # pragma: no cover
                     log.warning("Wrong entry, missing path: {}", data)
                     continue
                 else:
-                    ipath = Path(path, name)
-                    metadata = imain.get_metadata(ipath)
-                    data["URL"] = metadata.get("download")
+                    if name in links:
+                        data["URL"] = links[name]["url"]
+                    elif ORDER_AVU_MIRROR:
+                        metadata = imain.get_metadata(Path(path, name))
+                        data["URL"] = metadata.get("download")
+                    else:
+                        data["URL"] = None
                     response.append(data)
 
             msg = prepare_message(self, log_string="end", status="completed")
@@ -284,7 +401,14 @@ def post(self, user: User, **json_input: Any) -> Response:
             # Does the zip already exists?
             zip_file_name = filename + ".zip"
             zip_ipath = str(Path(order_path, zip_file_name))
-            if imain.is_dataobject(zip_ipath):
+            # Large orders are only saved as split zips
+            split_zip_ipath = str(
+                Path(
+                    order_path,
+                    get_order_zip_file_name(order_id, restricted=False, index=1),
+                )
+            )
+            if imain.is_dataobject(zip_ipath) or imain.is_dataobject(split_zip_ipath):
                 # give error here
                 # return {order_id: 'already exists'}
                 # json_input['status'] = 'exists'
@@ -307,26 +431,10 @@ def post(self, user: User, **json_input: Any) -> Response:
         except requests.exceptions.ReadTimeout:  # pragma: no cover
             raise ServiceUnavailable("B2SAFE is temporarily unavailable")
 
-    def no_slash_ticket(self, imain: irods.IrodsPythonExt, path: str) -> str:
-        """irods ticket for HTTP"""
-        # TODO: prc list tickets so we can avoid more than once
-        # TODO: investigate iticket expiration
-        # iticket mod Ticket_string-or-id uses/expire string-or-none
-
-        unwanted = ["/", "%"]
-        # Initialize the ticket with an unwanted characters to enter the first loop
-        ticket = unwanted[0]
-        # Create an iticket that does not contains any of the unwanted characters
-        while any(c in ticket for c in unwanted):
-            obj = imain.ticket(path)
-            ticket = obj.ticket
-        encoded = urllib.parse.quote_plus(ticket)
-        log.info("Ticket: {} -> {}", ticket, encoded)
-        return encoded
-
     def get_download(
         self,
         imain: irods.IrodsPythonExt,
+        downloads: OrderDownloads,
         order_id: str,
         order_path: str,
         files: Dict[str, Dict[str, Any]],
@@ -342,7 +450,21 @@ def get_download(
         zip_ipath = str(Path(order_path, zip_file_name))
         log.debug("Zip irods path: {}", zip_ipath)
 
-        code = self.no_slash_ticket(imain, zip_ipath)
+        info = files[zip_file_name]
+        size = info.get("content_length", 0)
+
+        # links still valid for a while are returned again, with the same ticket,
+        # unless the zip file has been replaced in the meantime
+        entry = downloads.get_reusable(order_id, zip_file_name)
+        if entry is not None and entry.get("size") == size:
+            return {"name": zip_file_name, "url": entry["url"], "size": size}
+        if entry is not None:
+            log.info("Zip file {} changed, issuing a new ticket", zip_file_name)
+
+        expires = downloads.get_expiration()
+        code = imain.issue_ticket(zip_ipath, expires=expires)
+        log.info("Ticket: {}", code)
+
         ftype = ""
         if restricted:
             ftype += "1"
@@ -361,24 +483,21 @@ def get_download(
 
         url = f"{host}/api/orders/{order_id}/download/{ftype}/c/{code}"
 
-        # If metadata already exists, remove them:
-        # FIXME: verify if iticket_code is set and then invalidate it
-        imain.remove_metadata(zip_ipath, "iticket_code")
-        imain.remove_metadata(zip_ipath, "download")
-        ##################
-        # Set the url as Metadata in the irods file
-        imain.set_metadata(zip_ipath, download=url)
-
-        # TOFIX: we should add a database or cache to save this,
-        # not irods metadata (known for low performances)
-        imain.set_metadata(zip_ipath, iticket_code=code)
+        downloads.set(order_id, zip_file_name, code, url, size, expires=expires)
 
-        info = files[zip_file_name]
+        if ORDER_AVU_MIRROR:
+            # If metadata already exists, remove them:
+            # the previous ticket is revoked by the sweep once expired
+            imain.set_metadata_bulk(
+                zip_ipath,
+                {"download": url, "iticket_code": code},
+                remove=["iticket_code", "download"],
+            )
 
         return {
             "name": zip_file_name,
             "url": url,
-            "size": info.get("content_length", 0),
+            "size": size,
         }
 
     @decorators.auth.require()
@@ -404,83 +523,32 @@ def put(self, order_id: str, user: User) -> Response:
             response = []
 
             files_in_irods = imain.list(order_path, detailed=True)
+            downloads = OrderDownloads(redis.get_instance().r, ORDER_DOWNLOAD_TTL)
 
-            # Going through all possible file names of zip files
-
-            # unrestricted zip
-            # info = self.get_download(
-            #     imain, order_id, order_path, files_in_irods,
-            #     restricted=False, index=None)
-            # if info is not None:
-            #     response.append(info)
-
-            # checking for splitted unrestricted zip
-            info = self.get_download(
-                imain, order_id, order_path, files_in_irods, restricted=False, index=1
-            )
-
-            # No split zip found, looking for the single unrestricted zip
-            if info is None:
-                info = self.get_download(
-                    imain,
-                    order_id,
-                    order_path,
-                    files_in_irods,
-                    restricted=False,
-                    index=None,
-                )
-                if info is not None:
-                    response.append(info)
-            # When found one split, looking for more:
-            else:
-                response.append(info)
-                for index in range(2, 100):
-                    info = self.get_download(
-                        imain,
-                        order_id,
-                        order_path,
-                        files_in_irods,
-                        restricted=False,
-                        index=index,
-                    )
-                    if info is not None:
-                        response.append(info)
-
-            # checking for splitted restricted zip
-            info = self.get_download(
-                imain, order_id, order_path, files_in_irods, restricted=True, index=1
-            )
+            parts = get_order_zip_parts(order_id, files_in_irods)
 
-            # No split zip found, looking for the single restricted zip
-            if info is None:
+            # the iRODS session is not thread safe, tickets are issued in turn
+            for restricted, index in parts:
                 info = self.get_download(
                     imain,
+                    downloads,
                     order_id,
                     order_path,
                     files_in_irods,
-                    restricted=True,
-                    index=None,
+                    restricted=restricted,
+                    index=index,
                 )
                 if info is not None:
                     response.append(info)
-            # When found one split, looking for more:
-            else:
-                response.append(info)
-                for index in range(2, 100):
-                    info = self.get_download(
-                        imain,
-                        order_id,
-                        order_path,
-                        files_in_irods,
-                        restricted=True,
-                        index=index,
-                    )
-                    if info is not None:
-                        response.append(info)
 
             if len(response) == 0:
                 raise NotFound(f"Order '{order_id}' not found (or no permissions)")
 
+            if downloads.should_sweep(TICKET_SWEEP_INTERVAL):
+                c = celery.get_instance()
+                task = c.celery_app.send_task("sweep_order_tickets")
+                log.info("Async job: {}", task.id)
+
             msg = prepare_message(self, log_string="end", status="enabled")
             log_into_queue(self, msg)
 
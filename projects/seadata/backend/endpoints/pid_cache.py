@@ -1,11 +1,13 @@
 import requests
 from restapi import decorators
-from restapi.connectors import celery
+from restapi.connectors import celery, redis
 from restapi.exceptions import NotFound, ServiceUnavailable
+from restapi.models import fields
 from restapi.rest.definition import Response
 from restapi.services.authentication import Role, User
 from restapi.utilities.logs import log
 from seadata.connectors import irods
+from seadata.connectors.pids_cache import PIDCache
 from seadata.endpoints import PRODUCTION_COLL, SeaDataEndpoint
 
 
@@ -14,17 +16,25 @@ class PidCache(SeaDataEndpoint):
     labels = ["helper"]
 
     @decorators.auth.require_any(Role.ADMIN, Role.STAFF)
+    # "description": "Start a full inspection of the cache instead",
+    @decorators.use_kwargs({"audit": fields.Bool()}, location="query")
     @decorators.endpoint(
         path="/pidcache",
-        summary="Retrieve values from the pid cache",
-        responses={200: "Async job started"},
+        summary="Retrieve statistics of the pid cache",
+        responses={
+            200: "Number of cached PIDs, by prefix and by batch, or async job started"
+        },
     )
-    def get(self, user: User) -> Response:
+    def get(self, user: User, audit: bool = False) -> Response:
+
+        if audit:
+            c = celery.get_instance()
+            task = c.celery_app.send_task("inspect_pids_cache")
+            log.info("Async job: {}", task.id)
+            return self.return_async_id(task.id)
 
-        c = celery.get_instance()
-        task = c.celery_app.send_task("inspect_pids_cache")
-        log.info("Async job: {}", task.id)
-        return self.return_async_id(task.id)
+        cache = PIDCache(redis.get_instance().r)
+        return self.response(cache.get_stats())
 
     @decorators.auth.require_any(Role.ADMIN, Role.STAFF)
     @decorators.endpoint(
@@ -23,7 +23,10 @@
         message="the imp module is deprecated in favour of importlib; see the module's documentation for alternative uses",
     )
 
+from pathlib import Path
+
 from restapi import decorators
+from restapi.connectors import redis
 from restapi.exceptions import BadRequest, NotFound
 from restapi.models import fields
 from restapi.rest.definition import Response
@@ -33,7 +36,10 @@
 from restapi.utilities.logs import log
 from seadata.connectors import irods
 from seadata.connectors.b2handle import PIDgenerator
-from seadata.endpoints import Metadata, SeaDataEndpoint
+from seadata.connectors.pids_cache import ResolvedPIDCache
+from seadata.endpoints import PID_RESOLUTION_TTL, Metadata, SeaDataEndpoint
+
+resolved_pids = ResolvedPIDCache(ttl=PID_RESOLUTION_TTL)
 
 
 class PIDEndpoint(SeaDataEndpoint, Uploader, Downloader):
@@ -54,31 +60,37 @@ class PIDEndpoint(SeaDataEndpoint, Uploader, Downloader):
     def get(self, pid: str, user: User, download: bool = False) -> Response:
         """Get metadata or file from pid"""
 
-        pmaker = PIDgenerator()
+        r = redis.get_instance().r
+        resolved = resolved_pids.get(r, pid)
+        if resolved is None:
+            pmaker = PIDgenerator()
+
+            b2handle_output = pmaker.check_pid_content(pid)
+            if b2handle_output is None:
+                raise BadRequest(f"PID {pid} not found")
 
-        b2handle_output = pmaker.check_pid_content(pid)
-        if b2handle_output is None:
-            raise BadRequest(f"PID {pid} not found")
+            log.debug("PID {} verified", pid)
+            ipath = pmaker.parse_pid_dataobject_path(b2handle_output)
 
-        log.debug("PID {} verified", pid)
-        ipath = pmaker.parse_pid_dataobject_path(b2handle_output)
+            if not ipath:
+                raise NotFound(f"Object referenced by {pid} cannot be found")
 
-        if not ipath:
-            raise NotFound(f"Object referenced by {pid} cannot be found")
+            imain = irods.get_instance()
+            metadata = imain.get_metadata(str(ipath))
 
+            resolved = {
+                "path": str(ipath),
+                "metadata": {k: v for k, v in metadata.items() if k in Metadata.keys},
+            }
+            resolved_pids.set(r, pid, resolved)
+
+        ipath = Path(resolved["path"])
         response = {
             "PID": pid,
             "verified": True,
-            "metadata": {},
+            "metadata": resolved["metadata"],
             "temp_id": ipath.name,
             "batch_id": ipath.parent.name,
         }
 
-        imain = irods.get_instance()
-        metadata = imain.get_metadata(str(ipath))
-
-        for key, value in metadata.items():
-            if key in Metadata.keys:
-                response["metadata"][key] = value  # type: ignore
-
         return self.response(response)
@@ -3,11 +3,13 @@
 from typing import Any, Dict, List
 
 from glom import glom
+from restapi.connectors import redis
 from restapi.connectors.celery import CeleryExt, Task
 from restapi.utilities.logs import log
 from restapi.utilities.processes import start_timeout, stop_timeout
 from seadata.connectors import irods
-from seadata.endpoints import ErrorCodes
+from seadata.connectors.order_downloads import OrderDownloads
+from seadata.endpoints import ORDER_DOWNLOAD_TTL, ErrorCodes
 from seadata.tasks.seadata import ext_api, notify_error
 
 TIMEOUT = 1800
@@ -47,6 +49,7 @@ def delete_orders(
         return notify_error(ErrorCodes.EMPTY_ORDERS_PARAMETER, myjson, backdoor, self)
 
     try:
+        downloads = OrderDownloads(redis.get_instance().r, ORDER_DOWNLOAD_TTL)
         with irods.get_instance() as imain:
 
             errors: List[Dict[str, str]] = []
@@ -92,6 +95,7 @@ def delete_orders(
                     # TODO: I should also revoke the task?
 
                     imain.remove(order_path, recursive=True)
+                    downloads.delete(order)
                     stop_timeout()
                 except BaseException as e:
                     log.error(e)
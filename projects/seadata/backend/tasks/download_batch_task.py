@@ -1,7 +1,5 @@
-import hashlib
 import zipfile
 from pathlib import Path
-from shutil import rmtree
 from typing import Any, Dict
 from urllib.parse import urljoin
 
@@ -11,19 +9,12 @@
 from restapi.utilities.processes import start_timeout, stop_timeout
 from seadata.connectors import irods
 from seadata.endpoints import ErrorCodes
-from seadata.tasks.seadata import ext_api, notify_error
+from seadata.tasks.downloader import DownloadError, DownloadSizeExceeded, download_file
+from seadata.tasks.seadata import ZIP_CRC_CHECK, ext_api, notify_error
+from seadata.tasks.zip_utils import count_zip_entries
 
 TIMEOUT = 1800
 
-DOWNLOAD_HEADERS = {
-    "User-Agent": "SDC CDI HTTP-APIs",
-    "Upgrade-Insecure-Requests": "1",
-    "DNT": "1",
-    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-    "Accept-Language": "en-US,en;q=0.5",
-    "Accept-Encoding": "gzip, deflate",
-}
-
 
 @CeleryExt.task(idempotent=False)
 def download_batch(
@@ -153,24 +144,17 @@ def download_batch(
             # 1 - download the file
             download_url = urljoin(download_path, file_name)
             log.info("Downloading file from {}", download_url)
+            batch_file = Path(local_path, file_name)
             try:
-                r = requests.get(
-                    download_url,
-                    stream=True,
-                    verify=False,
-                    headers=DOWNLOAD_HEADERS,
-                    timeout=120,
-                )
-            except requests.exceptions.ConnectionError:
-                return notify_error(
-                    ErrorCodes.UNREACHABLE_DOWNLOAD_PATH,
-                    myjson,
-                    backdoor,
-                    self,
-                    subject=download_url,
-                    edmo_code=request_edmo_code,
+                local_file_size, local_file_checksum = download_file(
+                    download_url, batch_file, max_size=int(file_size)
                 )
-            except requests.exceptions.MissingSchema as e:
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                requests.exceptions.MissingSchema,
+                DownloadError,
+            ) as e:
                 log.error(str(e))
                 return notify_error(
                     ErrorCodes.UNREACHABLE_DOWNLOAD_PATH,
@@ -180,30 +164,18 @@ def download_batch(
                     subject=download_url,
                     edmo_code=request_edmo_code,
                 )
-
-            if r.status_code != 200:
-
+            except DownloadSizeExceeded as e:
+                log.error("{}: {}", batch_file, e)
                 return notify_error(
-                    ErrorCodes.UNREACHABLE_DOWNLOAD_PATH,
+                    ErrorCodes.FILESIZE_DOESNT_MATCH,
                     myjson,
                     backdoor,
                     self,
-                    subject=download_url,
+                    subject=file_name,
                     edmo_code=request_edmo_code,
                 )
 
-            log.info("Request status = {}", r.status_code)
-            batch_file = Path(local_path, file_name)
-
-            with open(batch_file, "wb") as f:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
-
             # 2 - verify checksum
-            log.info("Computing checksum for {}...", batch_file)
-            local_file_checksum = hashlib.md5(open(batch_file, "rb").read()).hexdigest()
-
             if local_file_checksum.lower() != file_checksum.lower():
                 return notify_error(
                     ErrorCodes.CHECKSUM_DOESNT_MATCH,
@@ -216,7 +188,6 @@ def download_batch(
             log.info("File checksum verified for {}", batch_file)
 
             # 3 - verify size
-            local_file_size = batch_file.stat().st_size
             if local_file_size != int(file_size):
                 log.error(
                     "File size {} for {}, expected {}",
@@ -235,20 +206,12 @@ def download_batch(
 
             log.info("File size verified for {}", batch_file)
 
-            # 4 - decompress
-            local_unzipdir = Path(local_path, batch_file.stem)
-
-            if local_unzipdir.is_dir():
-                log.warning("{} already exist, removing it", local_unzipdir)
-                rmtree(local_unzipdir, ignore_errors=True)
-
-            local_unzipdir.mkdir()
-            log.info("Local unzip dir = {}", local_unzipdir)
-
-            log.info("Unzipping {}", batch_file)
-            zip_ref = None
+            # 4 - validate the zip from its central directory
+            log.info("Verifying zip entries of {}", batch_file)
             try:
-                zip_ref = zipfile.ZipFile(batch_file, "r")
+                local_file_count = count_zip_entries(
+                    batch_file, check_crc=ZIP_CRC_CHECK
+                )
             except FileNotFoundError:
                 return notify_error(
                     ErrorCodes.UNZIP_ERROR_FILE_NOT_FOUND,
@@ -259,7 +222,8 @@ def download_batch(
                     edmo_code=request_edmo_code,
                 )
 
-            except zipfile.BadZipFile:
+            except zipfile.BadZipFile as e:
+                log.error(e)
                 return notify_error(
                     ErrorCodes.UNZIP_ERROR_INVALID_FILE,
                     myjson,
@@ -269,14 +233,8 @@ def download_batch(
                     edmo_code=request_edmo_code,
                 )
 
-            if zip_ref is not None:
-                zip_ref.extractall(local_unzipdir)
-                zip_ref.close()
-
-            # 6 - verify num files?
-            local_file_count = len(list(local_unzipdir.iterdir()))
-
-            log.info("Unzipped {} files from {}", local_file_count, batch_file)
+            # 5 - verify num files?
+            log.info("Found {} files in {}", local_file_count, batch_file)
 
             if local_file_count != int(file_count):
                 log.error("Expected {} files for {}", file_count, batch_file)
@@ -291,8 +249,6 @@ def download_batch(
 
             log.info("File count verified for {}", batch_file)
 
-            rmtree(local_unzipdir, ignore_errors=True)
-
             # 7 - copy file from B2HOST filesystem to irods
 
             """
@@ -1,32 +1,71 @@
-import hashlib
+import json
 import os
 import re
 import zipfile
+from datetime import datetime
 from pathlib import Path
 from shutil import rmtree
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple, cast
 
 import requests
-from plumbum import local  # type: ignore
-from plumbum.commands.processes import ProcessExecutionError  # type: ignore
+from restapi.connectors import redis
 from restapi.connectors.celery import CeleryExt, Task
 from restapi.utilities.logs import log
 from restapi.utilities.processes import start_timeout, stop_timeout
 from seadata.connectors import irods
 from seadata.connectors.irods import IrodsException
-from seadata.endpoints import MOUNTPOINT, ORDERS_DIR, ErrorCodes
-from seadata.tasks.seadata import MAX_ZIP_SIZE, ext_api, notify_error
+from seadata.connectors.order_downloads import OrderDownloads
+from seadata.endpoints import (
+    MOUNTPOINT,
+    ORDER_DOWNLOAD_TTL,
+    ORDERS_DIR,
+    RESTRICTED_MANIFEST,
+    ErrorCodes,
+)
+from seadata.tasks.downloader import DownloadError, DownloadSizeExceeded, download_file
+from seadata.tasks.seadata import MAX_ZIP_SIZE, ZIP_CRC_CHECK, ext_api, notify_error
+from seadata.tasks.zip_utils import ZipEntryTooLarge, count_zip_entries, split_zip
 
 TIMEOUT = 1800
 
-DOWNLOAD_HEADERS = {
-    "User-Agent": "SDC CDI HTTP-APIs",
-    "Upgrade-Insecure-Requests": "1",
-    "DNT": "1",
-    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-    "Accept-Language": "en-US,en;q=0.5",
-    "Accept-Encoding": "gzip, deflate",
-}
+
+def load_manifest(
+    imain: irods.IrodsPythonExt, order_path: str, final_zip: Path
+) -> Dict[str, Any]:
+    """
+    Load the list of restricted zip parts already saved in the order.
+    Orders merged before the introduction of the manifest are described by
+    their split zips, if any, or by the single final zip (with index 0)
+    """
+
+    manifest_path = Path(order_path, RESTRICTED_MANIFEST)
+    if imain.is_dataobject(manifest_path):
+        return cast(
+            Dict[str, Any], json.loads(imain.read_file_content(str(manifest_path)))
+        )
+
+    parts: List[Dict[str, Any]] = []
+    regexp = re.compile(rf"^{re.escape(final_zip.stem)}([0-9]+)\.zip$")
+    for name in imain.list(order_path):
+        m = regexp.match(name)
+        if m:
+            parts.append({"name": name, "index": int(m.group(1))})
+
+    if parts:
+        parts.sort(key=lambda p: cast(int, p["index"]))
+    elif imain.is_dataobject(final_zip):
+        parts.append({"name": final_zip.name, "index": 0})
+
+    return {"zip_name": final_zip.name, "parts": parts}
+
+
+def save_manifest(
+    imain: irods.IrodsPythonExt, order_path: str, manifest: Dict[str, Any]
+) -> None:
+    manifest_path = str(Path(order_path, RESTRICTED_MANIFEST))
+    imain.create_empty(manifest_path, ignore_existing=True)
+    imain.write_file_content(manifest_path, json.dumps(manifest))
+    log.debug("Manifest saved in {}", manifest_path)
 
 
 def check_params(params: Dict[str, Any]) -> Optional[Tuple[str, str]]:
@@ -80,6 +119,7 @@ def download_restricted_order(
     order_path = order_path.rstrip("/")
 
     try:
+        downloads = OrderDownloads(redis.get_instance().r, ORDER_DOWNLOAD_TTL)
         with irods.get_instance() as imain:
             if not imain.is_collection(order_path):
                 return notify_error(
@@ -108,10 +148,8 @@ def download_restricted_order(
             # NAME OF FINAL ZIP
             filename = params.get("zipfile_name")
 
-            base_filename = filename
             if filename.endswith(".zip"):
                 log.warning("{} already contains extention .zip", filename)
-                # TO DO: save base_filename as filename - .zip
             else:
                 filename += ".zip"
 
@@ -158,7 +196,6 @@ def download_restricted_order(
             self.update_state(state="PROGRESS")
 
             errors: List[Dict[str, str]] = []
-            local_finalzip_path = None
             log.info("Merging zip file", file_name)
 
             if not file_name.endswith(".zip"):
@@ -167,24 +204,23 @@ def download_restricted_order(
             # 1 - download in local-dir
             download_url = os.path.join(download_path, file_name)
             log.info("Downloading file from {}", download_url)
+            local_dir = MOUNTPOINT.joinpath(ORDERS_DIR, order_id)
+            local_dir.mkdir(exist_ok=True)
+            log.info("Local dir = {}", local_dir)
+
+            local_zip_path = local_dir.joinpath(file_name)
+            log.info("partial_zip = {}", local_zip_path)
+
             try:
-                r = requests.get(
-                    download_url,
-                    stream=True,
-                    verify=False,
-                    headers=DOWNLOAD_HEADERS,
-                    timeout=120,
+                local_file_size, local_file_checksum = download_file(
+                    download_url, local_zip_path, max_size=int(file_size)
                 )
-            except requests.exceptions.ConnectionError:
-                return notify_error(
-                    ErrorCodes.UNREACHABLE_DOWNLOAD_PATH,
-                    myjson,
-                    backdoor,
-                    self,
-                    subject=download_url,
-                    edmo_code=request_edmo_code,
-                )
-            except requests.exceptions.MissingSchema as e:
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                requests.exceptions.MissingSchema,
+                DownloadError,
+            ) as e:
                 log.error(str(e))
                 return notify_error(
                     ErrorCodes.UNREACHABLE_DOWNLOAD_PATH,
@@ -194,38 +230,18 @@ def download_restricted_order(
                     subject=download_url,
                     edmo_code=request_edmo_code,
                 )
-
-            if r.status_code != 200:
-
+            except DownloadSizeExceeded as e:
+                log.error("{}: {}", local_zip_path, e)
                 return notify_error(
-                    ErrorCodes.UNREACHABLE_DOWNLOAD_PATH,
+                    ErrorCodes.FILESIZE_DOESNT_MATCH,
                     myjson,
                     backdoor,
                     self,
-                    subject=download_url,
+                    subject=file_name,
                     edmo_code=request_edmo_code,
                 )
 
-            log.info("Request status = {}", r.status_code)
-
-            local_dir = MOUNTPOINT.joinpath(ORDERS_DIR, order_id)
-            local_dir.mkdir(exist_ok=True)
-            log.info("Local dir = {}", local_dir)
-
-            local_zip_path = local_dir.joinpath(file_name)
-            log.info("partial_zip = {}", local_zip_path)
-
-            with open(local_zip_path, "wb") as f:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
-
             # 2 - verify checksum
-            log.info("Computing checksum for {}...", local_zip_path)
-            local_file_checksum = hashlib.md5(
-                open(local_zip_path, "rb").read()
-            ).hexdigest()
-
             if local_file_checksum.lower() != file_checksum.lower():
                 return notify_error(
                     ErrorCodes.CHECKSUM_DOESNT_MATCH,
@@ -238,7 +254,6 @@ def download_restricted_order(
             log.info("File checksum verified for {}", local_zip_path)
 
             # 3 - verify size
-            local_file_size = os.path.getsize(str(local_zip_path))
             if local_file_size != int(file_size):
                 log.error(
                     "File size {} for {}, expected {}",
@@ -257,21 +272,12 @@ def download_restricted_order(
 
             log.info("File size verified for {}", local_zip_path)
 
-            # 4 - decompress
-            d = os.path.splitext(os.path.basename(str(local_zip_path)))[0]
-            local_unzipdir = local_dir.joinpath(d)
-
-            if local_unzipdir.exists():
-                log.warning("{} already exist, removing it", local_unzipdir)
-                rmtree(local_unzipdir, ignore_errors=True)
-
-            local_unzipdir.mkdir()
-            log.info("Local unzip dir = {}", local_unzipdir)
-
-            log.info("Unzipping {}", local_zip_path)
-            zip_ref = None
+            # 4 - validate the zip from its central directory
+            log.info("Verifying zip entries of {}", local_zip_path)
             try:
-                zip_ref = zipfile.ZipFile(local_zip_path, "r")
+                local_file_count = count_zip_entries(
+                    local_zip_path, check_crc=ZIP_CRC_CHECK
+                )
             except FileNotFoundError:
                 return notify_error(
                     ErrorCodes.UNZIP_ERROR_FILE_NOT_FOUND,
@@ -282,7 +288,8 @@ def download_restricted_order(
                     edmo_code=request_edmo_code,
                 )
 
-            except zipfile.BadZipFile:
+            except zipfile.BadZipFile as e:
+                log.error(e)
                 return notify_error(
                     ErrorCodes.UNZIP_ERROR_INVALID_FILE,
                     myjson,
@@ -292,14 +299,8 @@ def download_restricted_order(
                     edmo_code=request_edmo_code,
                 )
 
-            if zip_ref is not None:
-                zip_ref.extractall(str(local_unzipdir))
-                zip_ref.close()
-
             # 5 - verify num files?
-            local_file_count = len(os.listdir(str(local_unzipdir)))
-
-            log.info("Unzipped {} files from {}", local_file_count, local_zip_path)
+            log.info("Found {} files in {}", local_file_count, local_zip_path)
 
             if local_file_count != int(file_count):
                 log.error("Expected {} files for {}", file_count, local_zip_path)
@@ -314,25 +315,36 @@ def download_restricted_order(
 
             log.info("File count verified for {}", local_zip_path)
 
+            # 6 - the partner zip is saved as a new part of the final zip,
+            # the parts already merged are tracked by the order manifest
             log.info("Verifying final zip: {}", final_zip)
-            # 6 - check if final_zip exists
-            if not imain.exists(str(final_zip)):
-                # 7 - if not, simply copy partial_zip -> final_zip
-                log.info("Final zip does not exist, copying partial zip")
+            try:
+                manifest = load_manifest(imain, order_path, final_zip)
+            except BaseException as e:
+                log.error(e)
+                return notify_error(
+                    ErrorCodes.UNEXPECTED_ERROR,
+                    myjson,
+                    backdoor,
+                    self,
+                    subject=final_zip,
+                    edmo_code=request_edmo_code,
+                )
+
+            parts: List[Dict[str, Any]] = manifest["parts"]
+            part_base = final_zip.stem
+
+            # 7 - if the final zip is a single file, turn it into the first part
+            if parts and parts[0]["index"] == 0:
+                first_part = Path(order_path, f"{part_base}1.zip")
+                log.info("Final zip already exists, renaming it as {}", first_part)
                 try:
-                    start_timeout(TIMEOUT)
-                    imain.put(str(local_zip_path), str(final_zip))
-                    stop_timeout()
-                except IrodsException as e:
-                    log.error(str(e))
-                    return notify_error(
-                        ErrorCodes.B2SAFE_UPLOAD_ERROR,
-                        myjson,
-                        backdoor,
-                        self,
-                        subject=file_name,
-                        edmo_code=request_edmo_code,
-                    )
+                    imain.move(final_zip, first_part)
+                    parts[0].update(name=first_part.name, index=1)
+                    save_manifest(imain, order_path, manifest)
+                    # link and local copy no longer match any file on iRODS
+                    local_dir.joinpath(final_zip.name).unlink(missing_ok=True)
+                    downloads.forget(order_id, final_zip.name)
                 except BaseException as e:
                     log.error(e)
                     return notify_error(
@@ -340,92 +352,85 @@ def download_restricted_order(
                         myjson,
                         backdoor,
                         self,
-                        subject=file_name,
+                        subject=final_zip,
                         edmo_code=request_edmo_code,
                     )
-                local_finalzip_path = local_zip_path
+
+            # 8 - only the partner zip is uploaded, split if too large
+            next_index = max((p["index"] for p in parts), default=0) + 1
+            new_parts: List[Tuple[Path, int]] = []
+            if local_file_size <= MAX_ZIP_SIZE:
+                # The first zip is saved as the final zip, with no index
+                index = next_index if parts else 0
+                part_name = f"{part_base}{index}.zip" if index else final_zip.name
+                local_part = local_dir.joinpath(part_name)
+                local_zip_path.replace(local_part)
+                new_parts.append((local_part, index))
             else:
-                # 8 - if already exists merge zips
-                log.info("Already exists, merge zip files")
+                log.warning("Zip too large, splitting {}", local_zip_path)
+
+                # Create a sub folder for split files. If already exists,
+                # remove it before to start from a clean environment
+                split_path = Path(local_dir, "restricted_zip_split")
+                # split_path is an object
+                rmtree(split_path, ignore_errors=True)
+                # path create requires a path object
+                split_path.mkdir()
 
-                log.info("Copying zipfile locally")
-                local_finalzip_path = local_dir.joinpath(final_zip.name)
                 try:
-                    start_timeout(TIMEOUT)
-                    imain.open(str(final_zip), str(local_finalzip_path))
-                    stop_timeout()
-                except BaseException as e:
-                    log.error(e)
+                    zip_files = split_zip(
+                        local_zip_path,
+                        split_path,
+                        part_base,
+                        MAX_ZIP_SIZE,
+                        first_index=next_index,
+                    )
+                except ZipEntryTooLarge as e:
                     return notify_error(
-                        ErrorCodes.UNEXPECTED_ERROR,
+                        ErrorCodes.ZIP_SPLIT_ENTRY_TOO_LARGE,
                         myjson,
                         backdoor,
                         self,
-                        subject=final_zip,
+                        extra=str(e),
                         edmo_code=request_edmo_code,
                     )
-
-                log.info("Reading local zipfile")
-                zip_ref = None
-                try:
-                    zip_ref = zipfile.ZipFile(local_finalzip_path, "a")
-                except FileNotFoundError:
-                    log.error("Local file not found: {}", local_finalzip_path)
+                except BaseException as e:
+                    log.error(e)
                     return notify_error(
-                        ErrorCodes.UNZIP_ERROR_FILE_NOT_FOUND,
+                        ErrorCodes.ZIP_SPLIT_ERROR,
                         myjson,
                         backdoor,
                         self,
-                        subject=final_zip,
+                        extra=str(local_zip_path),
                         edmo_code=request_edmo_code,
                     )
 
-                except zipfile.BadZipFile:
-                    log.error("Invalid local file: {}", local_finalzip_path)
+                for index, subzip_path in enumerate(zip_files, start=next_index):
+                    local_part = local_dir.joinpath(subzip_path.name)
+                    subzip_path.replace(local_part)
+                    new_parts.append((local_part, index))
+                local_zip_path.unlink(missing_ok=True)
+                rmtree(split_path, ignore_errors=True)
+
+            for local_part, index in new_parts:
+                part_ipath = Path(order_path, local_part.name)
+                log.info("Uploading {} -> {}", local_part, part_ipath)
+                try:
+                    start_timeout(TIMEOUT)
+                    imain.put(str(local_part), str(part_ipath))
+                    stop_timeout()
+                    downloads.forget(order_id, local_part.name)
+                    downloads.set_local_copy(order_id, local_part)
+                except IrodsException as e:
+                    log.error(str(e))
                     return notify_error(
-                        ErrorCodes.UNZIP_ERROR_INVALID_FILE,
+                        ErrorCodes.B2SAFE_UPLOAD_ERROR,
                         myjson,
                         backdoor,
                         self,
-                        subject=final_zip,
+                        subject=file_name,
                         edmo_code=request_edmo_code,
                     )
-
-                log.info("Adding files to local zipfile")
-                if zip_ref is not None:
-                    try:
-                        for loc_file in os.listdir(str(local_unzipdir)):
-                            # log.debug("Adding {}", loc_file)
-                            zip_ref.write(
-                                os.path.join(str(local_unzipdir), loc_file), loc_file
-                            )
-                        zip_ref.close()
-                    except BaseException as e:
-                        log.error(e)
-                        return notify_error(
-                            ErrorCodes.UNABLE_TO_CREATE_ZIP_FILE,
-                            myjson,
-                            backdoor,
-                            self,
-                            subject=final_zip,
-                            edmo_code=request_edmo_code,
-                        )
-
-                log.info("Creating a backup copy of final zip")
-                try:
-                    start_timeout(TIMEOUT)
-                    backup_zip = final_zip.with_suffix(".bak")
-                    if imain.is_dataobject(backup_zip):
-                        log.info(
-                            "{} already exists, removing previous backup",
-                            backup_zip,
-                        )
-                        imain.remove(backup_zip)
-                    imain.move(final_zip, backup_zip)
-
-                    log.info("Uploading final updated zip")
-                    imain.put(str(local_finalzip_path), str(final_zip))
-                    stop_timeout()
                 except BaseException as e:
                     log.error(e)
                     return notify_error(
@@ -433,99 +438,37 @@ def download_restricted_order(
                         myjson,
                         backdoor,
                         self,
-                        subject=final_zip,
+                        subject=part_ipath,
                         edmo_code=request_edmo_code,
                     )
 
-                # imain.remove(local_zip_path)
-            rmtree(local_unzipdir, ignore_errors=True)
-
-            self.update_state(state="COMPLETED")
-
-            if os.path.getsize(str(local_finalzip_path)) > MAX_ZIP_SIZE:
-                log.warning("Zip too large, splitting {}", local_finalzip_path)
-
-                # Create a sub folder for split files. If already exists,
-                # remove it before to start from a clean environment
-                split_path = Path(local_dir, "restricted_zip_split")
-                # split_path is an object
-                rmtree(split_path, ignore_errors=True)
-                # path create requires a path object
-                split_path.mkdir()
-
-                # Execute the split of the whole zip
-                split_params = [
-                    "-n",
-                    MAX_ZIP_SIZE,
-                    "-b",
-                    str(split_path),
-                    local_finalzip_path,
-                ]
+                parts.append(
+                    {
+                        "name": part_ipath.name,
+                        "index": index,
+                        "source": file_name,
+                        "checksum": local_file_checksum,
+                        "size": local_part.stat().st_size,
+                        "request_id": myjson["parameters"]["request_id"],
+                        "datetime": datetime.now().strftime("%Y%m%dT%H:%M:%S"),
+                    }
+                )
+                # saved after each part, so that a retry of the task
+                # continues after the parts already uploaded
                 try:
-                    zipsplit = local["/usr/bin/zipsplit"]
-                    zipsplit(split_params)
-                except ProcessExecutionError as e:
-
-                    if "Entry is larger than max split size" in e.stdout:
-                        reg = r"Entry too big to split, read, or write \((.*)\)"
-                        extra = None
-                        m = re.search(reg, e.stdout)
-                        if m:
-                            extra = m.group(1)
-                        return notify_error(
-                            ErrorCodes.ZIP_SPLIT_ENTRY_TOO_LARGE,
-                            myjson,
-                            backdoor,
-                            self,
-                            extra=extra,
-                            edmo_code=request_edmo_code,
-                        )
-                    else:
-                        log.error(e.stdout)
-
+                    save_manifest(imain, order_path, manifest)
+                except BaseException as e:
+                    log.error(e)
                     return notify_error(
-                        ErrorCodes.ZIP_SPLIT_ERROR,
+                        ErrorCodes.UNEXPECTED_ERROR,
                         myjson,
                         backdoor,
                         self,
-                        extra=str(local_finalzip_path),
+                        subject=RESTRICTED_MANIFEST,
                         edmo_code=request_edmo_code,
                     )
 
-                regexp = "^.*[^0-9]([0-9]+).zip$"
-                zip_files = os.listdir(split_path)
-                for subzip_file in zip_files:
-                    m = re.search(regexp, subzip_file)
-                    if not m:
-                        log.error("Cannot extract index from zip name: {}", subzip_file)
-                        return notify_error(
-                            ErrorCodes.INVALID_ZIP_SPLIT_OUTPUT,
-                            myjson,
-                            backdoor,
-                            self,
-                            extra=str(local_finalzip_path),
-                        )
-                    index = m.group(1).lstrip("0")
-                    subzip_path = split_path.joinpath(subzip_file)
-
-                    subzip_ifile = f"{base_filename}{index}.zip"
-                    subzip_ipath = Path(order_path, subzip_ifile)
-
-                    log.info("Uploading {} -> {}", subzip_path, subzip_ipath)
-                    try:
-                        start_timeout(TIMEOUT)
-                        imain.put(str(subzip_path), str(subzip_ipath))
-                        stop_timeout()
-                    except BaseException as e:
-                        log.error(e)
-                        return notify_error(
-                            ErrorCodes.UNEXPECTED_ERROR,
-                            myjson,
-                            backdoor,
-                            self,
-                            subject=subzip_path,
-                            edmo_code=request_edmo_code,
-                        )
+            self.update_state(state="COMPLETED")
 
             if len(errors) > 0:
                 myjson["errors"] = errors
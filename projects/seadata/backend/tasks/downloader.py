@@ -0,0 +1,372 @@
+"""
+Streaming and resumable download of the files provided by the partners
+"""
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+from restapi.utilities.logs import log
+from seadata.tasks.seadata import (
+    DOWNLOAD_CHUNK_SIZE,
+    DOWNLOAD_RETRIES,
+    DOWNLOAD_SEGMENTS,
+)
+
+DOWNLOAD_HEADERS = {
+    "User-Agent": "SDC CDI HTTP-APIs",
+    "Upgrade-Insecure-Requests": "1",
+    "DNT": "1",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Accept-Encoding": "gzip, deflate",
+}
+
+TIMEOUT = 120
+RETRY_WAIT = 5
+# Bytes received between two updates of the download state
+STATE_SAVE_INTERVAL = 67108864  # 64 mb
+
+# Interrupted transfers, resumed from the last received byte
+RETRYABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+# [first byte, end byte (excluded, None if unknown), next byte to be received]
+Segment = List[Optional[int]]
+
+
+class DownloadError(Exception):
+    """The server refused the download"""
+
+
+class DownloadSizeExceeded(Exception):
+    """The downloaded data exceeds the declared file size"""
+
+    def __init__(self, size: int, max_size: int) -> None:
+        super().__init__(f"Received more than {max_size} bytes ({size})")
+        self.size = size
+        self.max_size = max_size
+
+
+def get_headers(**extra: str) -> Dict[str, str]:
+    headers = DOWNLOAD_HEADERS.copy()
+    # Byte offsets are only meaningful on the unencoded representation
+    headers["Accept-Encoding"] = "identity"
+    headers.update(extra)
+    return headers
+
+
+def get_validator(response: requests.Response) -> Optional[str]:
+    """The value to be sent as If-Range when resuming the download"""
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+
+def get_content_length(response: requests.Response) -> Optional[int]:
+    try:
+        return int(response.headers["Content-Length"])
+    except (KeyError, ValueError):
+        return None
+
+
+class PartialDownload:
+    """
+    The data received so far (<destination>.part) and the state needed to
+    resume the transfer (<destination>.part.json): source url, validator,
+    total size and the received byte ranges.
+    The md5 state cannot be serialized with hashlib, so on resume the
+    received data is hashed again from the local disk
+    """
+
+    def __init__(self, destination: Path, url: str) -> None:
+        self.destination = destination
+        self.url = url
+        self.path = destination.with_name(f"{destination.name}.part")
+        self.state_path = destination.with_name(f"{destination.name}.part.json")
+        self.validator: Optional[str] = None
+        self.size: Optional[int] = None
+        self.segments: List[Segment] = []
+
+    def load(self) -> bool:
+        """Restore the state of a previous download of the same url"""
+        try:
+            state = json.loads(self.state_path.read_text())
+        except (OSError, ValueError):
+            return False
+
+        if state.get("url") != self.url or not self.path.exists():
+            return False
+
+        self.validator = state.get("validator")
+        self.size = state.get("size")
+        self.segments = state.get("segments", [])
+        return bool(self.segments)
+
+    def save(self) -> None:
+        state: Dict[str, Any] = {
+            "url": self.url,
+            "validator": self.validator,
+            "size": self.size,
+            "segments": self.segments,
+        }
+        tmp_path = self.state_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(state))
+        tmp_path.replace(self.state_path)
+
+    def reset(
+        self, validator: Optional[str], size: Optional[int], segments: List[Segment]
+    ) -> None:
+        self.validator = validator
+        self.size = size
+        self.segments = segments
+        self.save()
+
+    def discard(self) -> None:
+        self.path.unlink(missing_ok=True)
+        self.state_path.unlink(missing_ok=True)
+        self.segments = []
+
+    def complete(self) -> None:
+        self.path.replace(self.destination)
+        self.state_path.unlink(missing_ok=True)
+
+
+def hash_file(path: Path, md5: Any, length: int, chunk_size: int) -> None:
+    """Add the first length bytes of the file to the md5"""
+    with open(path, "rb") as f:
+        while length > 0:
+            data = f.read(min(chunk_size, length))
+            if not data:
+                raise DownloadError(f"{path} is shorter than expected")
+            md5.update(data)
+            length -= len(data)
+
+
+def fetch_sequential(
+    partial: PartialDownload, max_size: Optional[int], chunk_size: int
+) -> Tuple[int, str]:
+    """Download the file in a single stream, resuming from the received data"""
+
+    offset = 0
+    md5 = hashlib.md5()
+    headers = get_headers()
+    if partial.segments and partial.segments[0][2]:
+        offset = int(partial.segments[0][2])
+        hash_file(partial.path, md5, offset, chunk_size)
+        headers["Range"] = f"bytes={offset}-"
+        if partial.validator:
+            headers["If-Range"] = partial.validator
+
+    with requests.get(
+        partial.url, stream=True, verify=False, headers=headers, timeout=TIMEOUT
+    ) as r:
+
+        if offset and r.status_code == 416:
+            log.warning("Cannot resume {}, restarting the download", partial.url)
+            partial.discard()
+            return fetch_sequential(partial, max_size, chunk_size)
+
+        if offset and r.status_code == 206:
+            log.info("Resuming the download of {} from {}", partial.url, offset)
+        elif r.status_code == 200:
+            if offset:
+                log.warning("Cannot resume {}, restarting the download", partial.url)
+                offset = 0
+                md5 = hashlib.md5()
+            partial.reset(get_validator(r), get_content_length(r), [[0, None, 0]])
+        else:
+            raise DownloadError(f"{partial.url}: status {r.status_code}")
+
+        log.info("Request status = {}", r.status_code)
+        length = get_content_length(r)
+        if max_size is not None and length is not None and offset + length > max_size:
+            raise DownloadSizeExceeded(offset + length, max_size)
+
+        size = saved = offset
+        with open(partial.path, "r+b" if offset else "wb") as f:
+            f.seek(offset)
+            f.truncate()
+            try:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    if not chunk:  # filter out keep-alive new chunks
+                        continue
+                    if max_size is not None and size + len(chunk) > max_size:
+                        raise DownloadSizeExceeded(size + len(chunk), max_size)
+                    md5.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+                    if size - saved >= STATE_SAVE_INTERVAL:
+                        f.flush()
+                        partial.segments[0][2] = saved = size
+                        partial.save()
+            except RETRYABLE_ERRORS:
+                f.flush()
+                partial.segments[0][2] = size
+                partial.save()
+                raise
+
+    return size, md5.hexdigest()
+
+
+def fetch_segments(
+    partial: PartialDownload, workers: int, chunk_size: int
+) -> Tuple[int, str]:
+    """Download the byte ranges of the file concurrently, one request each"""
+
+    size = int(partial.size or 0)
+    if not partial.path.exists():
+        with open(partial.path, "wb") as f:
+            f.truncate(size)
+
+    lock = Lock()
+
+    def fetch(segment: Segment) -> None:
+        start, end = int(segment[0] or 0), int(segment[1] or 0)
+        received = int(segment[2] or start)
+        if received >= end:
+            return
+
+        headers = get_headers(Range=f"bytes={received}-{end - 1}")
+        if partial.validator:
+            headers["If-Range"] = partial.validator
+
+        with requests.get(
+            partial.url, stream=True, verify=False, headers=headers, timeout=TIMEOUT
+        ) as r:
+            if r.status_code != 206:
+                raise DownloadError(f"{partial.url}: range status {r.status_code}")
+
+            saved = received
+            fd = os.open(partial.path, os.O_WRONLY)
+            try:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    if not chunk:  # filter out keep-alive new chunks
+                        continue
+                    if received + len(chunk) > end:
+                        raise DownloadError(f"{partial.url}: range exceeded")
+                    os.pwrite(fd, chunk, received)
+                    received += len(chunk)
+                    if received - saved >= STATE_SAVE_INTERVAL:
+                        with lock:
+                            segment[2] = saved = received
+                            partial.save()
+            finally:
+                os.close(fd)
+                with lock:
+                    segment[2] = received
+                    partial.save()
+
+        if received < end:
+            raise requests.exceptions.ChunkedEncodingError(
+                f"{partial.url}: bytes {start}-{end - 1} incomplete"
+            )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # consume the results to raise the first failure, if any
+        list(executor.map(fetch, partial.segments))
+
+    md5 = hashlib.md5()
+    hash_file(partial.path, md5, size, chunk_size)
+    return size, md5.hexdigest()
+
+
+def init_segments(
+    partial: PartialDownload, segments: int, max_size: Optional[int]
+) -> None:
+    """
+    Split the download into byte ranges, if the server accepts them.
+    Otherwise no segment is defined and the file is downloaded sequentially
+    """
+
+    with requests.head(
+        partial.url,
+        verify=False,
+        headers=get_headers(),
+        timeout=TIMEOUT,
+        allow_redirects=True,
+    ) as r:
+        size = get_content_length(r)
+        if (
+            r.status_code != 200
+            or r.headers.get("Accept-Ranges") != "bytes"
+            or not size
+        ):
+            log.info("Ranges not supported by {}", partial.url)
+            return None
+
+        if max_size is not None and size > max_size:
+            raise DownloadSizeExceeded(size, max_size)
+
+        step = -(-size // segments)
+        ranges: List[Segment] = [
+            [start, min(start + step, size), start] for start in range(0, size, step)
+        ]
+        partial.reset(get_validator(r), size, ranges)
+
+
+def download_file(
+    url: str,
+    destination: Path,
+    max_size: Optional[int] = None,
+    segments: int = DOWNLOAD_SEGMENTS,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+    retries: int = DOWNLOAD_RETRIES,
+) -> Tuple[int, str]:
+    """
+    Download url into destination computing size and md5 checksum.
+    Interrupted transfers are resumed with HTTP Range requests, both within
+    the retries of this call and from the .part file left by a previous task.
+    With segments > 1 byte ranges are downloaded concurrently when the server
+    allows it. Without range support the file is downloaded from the start.
+    Raise DownloadError if the server refuses the download and
+    DownloadSizeExceeded as soon as more than max_size bytes are received
+    """
+
+    partial = PartialDownload(destination, url)
+    if not partial.load():
+        partial.discard()
+
+    attempt = 1
+    while True:
+        try:
+            if not partial.segments and segments > 1:
+                init_segments(partial, segments, max_size)
+
+            if len(partial.segments) > 1:
+                try:
+                    size, checksum = fetch_segments(partial, segments, chunk_size)
+                except DownloadError as e:
+                    log.warning("Parallel download failed ({}), restarting", e)
+                    partial.discard()
+                    size, checksum = fetch_sequential(partial, max_size, chunk_size)
+            else:
+                size, checksum = fetch_sequential(partial, max_size, chunk_size)
+        except DownloadSizeExceeded:
+            partial.discard()
+            raise
+        except RETRYABLE_ERRORS as e:
+            if attempt >= retries:
+                raise e
+            log.warning(
+                "Download of {} interrupted ({}), retry {}/{}",
+                url,
+                e,
+                attempt,
+                retries - 1,
+            )
+            attempt += 1
+            time.sleep(RETRY_WAIT)
+        else:
+            partial.complete()
+            log.info("Downloaded {} bytes into {}", size, destination)
+            return size, checksum
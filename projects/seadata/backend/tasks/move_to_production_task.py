@@ -1,22 +1,38 @@
 import json
-import time
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
 from restapi.connectors import redis
 from restapi.connectors.celery import CeleryExt, Task
 from restapi.utilities.logs import log
-from restapi.utilities.processes import start_timeout, stop_timeout
 from seadata.connectors import irods
 from seadata.connectors.b2handle import PIDgenerator
+from seadata.connectors.irods.retry import retry_policy
+from seadata.connectors.irods.transfers import Stage, run_pipeline
+from seadata.connectors.pids_cache import PIDCache
 from seadata.connectors.rabbit_queue import prepare_message
 from seadata.endpoints import INGESTION_DIR, MOUNTPOINT, ErrorCodes
 from seadata.endpoints import Metadata as md
-from seadata.tasks.seadata import ext_api, notify_error
+from seadata.tasks.seadata import (
+    PID_BATCH_SIZE,
+    PID_WORKERS,
+    PRODUCTION_WORKERS,
+    ext_api,
+    notify_error,
+)
 
 pmaker = PIDgenerator()
 
-TIMEOUT = 1800
+# Error reported for files failed in each stage, if not more specific
+STAGE_ERRORS = {
+    "upload": ErrorCodes.UNABLE_TO_MOVE_IN_PRODUCTION,
+    "pid": ErrorCodes.UNABLE_TO_ASSIGN_PID,
+    "metadata": ErrorCodes.UNABLE_TO_SET_METADATA,
+}
+
+# A file to be moved in production: its index in the input list, the input
+# element, the local and irods paths and, once minted, its PID
+Job = Dict[str, Any]
 
 
 @CeleryExt.task(idempotent=False)
@@ -35,199 +51,145 @@ def move_to_production_task(
     local_path = MOUNTPOINT.joinpath(INGESTION_DIR, batch_id)
 
     try:
-        with irods.get_instance() as imain:
-
-            out_data = []
-            errors: List[Dict[str, str]] = []
-            counter = 0
-            param_key = "parameters"
-            params = myjson.get(param_key, {})
-            elements = params.get("pids", {})
-            backdoor = params.pop("backdoor", False)
-            total = len(elements)
-            self.update_state(
-                state="PROGRESS",
-                meta={"total": total, "step": counter, "errors": len(errors)},
-            )
-
-            if elements is None:
-                return notify_error(
-                    ErrorCodes.MISSING_PIDS_LIST, myjson, backdoor, self
-                )
-
-            MAX_RETRIES = 5
-            SLEEP_TIME = 120
-
-            r = redis.get_instance().r
-
-            for element in elements:
-
-                temp_id = element.get("temp_id")  # do not pop
-                record_id = element.get("format_n_code")
-                local_element = local_path.joinpath(temp_id)
-                # it is not equal to temp_id !?
-                current_file_name = local_element.name
-
-                # [fs -> irods]
+        out_data: List[Tuple[int, Dict[str, Any]]] = []
+        errors: List[Dict[str, str]] = []
+        counter = 0
+        param_key = "parameters"
+        params = myjson.get(param_key, {})
+        elements = params.get("pids", {})
+        backdoor = params.pop("backdoor", False)
+        total = len(elements)
+        self.update_state(
+            state="PROGRESS",
+            meta={"total": total, "step": counter, "errors": len(errors)},
+        )
+
+        if elements is None:
+            return notify_error(ErrorCodes.MISSING_PIDS_LIST, myjson, backdoor, self)
+
+        cache = PIDCache(redis.get_instance().r)
+
+        ###############
+        # 1. copy file (irods) [fs -> irods]
+        def upload(
+            imain: irods.IrodsPythonExt, jobs: List[Job]
+        ) -> List[Optional[Tuple[str, str]]]:
+            failures: List[Optional[Tuple[str, str]]] = []
+            for job in jobs:
+                local_element = job["local"]
                 # Exists and has size greater than zero
                 if local_element.exists() and local_element.stat().st_size > 0:
                     log.info("Found: {}", local_element)
                 else:
                     log.error("NOT found: {}", local_element)
-                    errors.append(
-                        {
-                            "error": ErrorCodes.INGESTION_FILE_NOT_FOUND[0],
-                            "description": ErrorCodes.INGESTION_FILE_NOT_FOUND[1],
-                            "subject": record_id,
-                        }
-                    )
-
-                    self.update_state(
-                        state="PROGRESS",
-                        meta={"total": total, "step": counter, "errors": len(errors)},
-                    )
+                    failures.append(ErrorCodes.INGESTION_FILE_NOT_FOUND)
                     continue
 
-                ###############
-                # 1. copy file (irods) [fs -> irods]
-                ifile = str(Path(cloud_path, current_file_name))
-                for i in range(MAX_RETRIES):
-                    try:
-                        start_timeout(TIMEOUT)
-                        imain.put(str(local_element), str(ifile))
-                        log.info("File copied on irods: {}", ifile)
-                        stop_timeout()
-                        break
-                    except BaseException as e:
-                        log.error(e)
-                        time.sleep(SLEEP_TIME)
-                        continue
-                else:
+                # transient errors are retried by the connector
+                try:
+                    imain.put(str(local_element), job["ifile"])
+                    log.info("File copied on irods: {}", job["ifile"])
+                    failures.append(None)
+                except BaseException as e:
+                    log.error(e)
                     # failed upload for the file
-                    errors.append(
-                        {
-                            "error": ErrorCodes.UNABLE_TO_MOVE_IN_PRODUCTION[0],
-                            "description": ErrorCodes.UNABLE_TO_MOVE_IN_PRODUCTION[1],
-                            "subject": record_id,
-                        }
-                    )
-
-                    self.update_state(
-                        state="PROGRESS",
-                        meta={"total": total, "step": counter, "errors": len(errors)},
-                    )
-                    continue
-
-                ###############
-                # 2. request pid (irule)
-                for i in range(MAX_RETRIES):
-                    try:
-                        start_timeout(TIMEOUT)
-                        if backdoor:
-                            log.warning("Backdoor enabled: skipping PID request")
-                            PID = "NO_PID_WITH_BACKDOOR"
-                        else:
-                            PID = pmaker.pid_request(imain, ifile)
-                        log.info("PID: {}", PID)
-                        # # save inside the cache
-                        r.set(PID, ifile)
-                        r.set(ifile, PID)
-                        log.debug("PID cache updated")
-                        stop_timeout()
-                        break
-                    except BaseException as e:
-                        log.error(e)
-                        time.sleep(SLEEP_TIME)
-                        continue
-
-                else:
+                    failures.append(ErrorCodes.UNABLE_TO_MOVE_IN_PRODUCTION)
+            return failures
+
+        ###############
+        # 2. request pids (irule), for all the files already copied
+        def request_pids(
+            imain: irods.IrodsPythonExt, jobs: List[Job]
+        ) -> List[Optional[Tuple[str, str]]]:
+            ifiles = [job["ifile"] for job in jobs]
+            if backdoor:
+                log.warning("Backdoor enabled: skipping PID request")
+                pids = {ifile: "NO_PID_WITH_BACKDOOR" for ifile in ifiles}
+            else:
+                pids, _ = pmaker.mint_pids(imain, ifiles, batch_size=PID_BATCH_SIZE)
+
+            if pids:
+                # save inside the cache
+                cache.store({PID: ifile for ifile, PID in pids.items()})
+                log.debug("PID cache updated with {} PIDs", len(pids))
+
+            failures: List[Optional[Tuple[str, str]]] = []
+            for job in jobs:
+                job["pid"] = pids.get(job["ifile"])
+                if job["pid"] is None:
                     # failed PID assignment
-                    errors.append(
-                        {
-                            "error": ErrorCodes.UNABLE_TO_ASSIGN_PID[0],
-                            "description": ErrorCodes.UNABLE_TO_ASSIGN_PID[1],
-                            "subject": record_id,
-                        }
-                    )
-
-                    self.update_state(
-                        state="PROGRESS",
-                        meta={"total": total, "step": counter, "errors": len(errors)},
-                    )
-                    continue
-
-                ###############
-                # 3. set metadata (icat)
-                # Remove me in a near future
-                for i in range(MAX_RETRIES):
-                    try:
-                        start_timeout(TIMEOUT)
-                        metadata = imain.get_metadata(ifile)
-
-                        for key in md.keys:
-                            if key not in metadata:
-                                value = element.get(key, "***MISSING***")
-                                args = {"path": ifile, key: value}
-                                imain.set_metadata(**args)
-                        log.debug("Metadata set for {}", current_file_name)
-                        stop_timeout()
-                        break
-                    except BaseException as e:
-                        log.error(e)
-                        time.sleep(SLEEP_TIME)
-                        continue
-                else:
-                    # failed metadata setting
-                    errors.append(
-                        {
-                            "error": ErrorCodes.UNABLE_TO_SET_METADATA[0],
-                            "description": ErrorCodes.UNABLE_TO_SET_METADATA[1],
-                            "subject": record_id,
-                        }
-                    )
-
-                    self.update_state(
-                        state="PROGRESS",
-                        meta={"total": total, "step": counter, "errors": len(errors)},
-                    )
-                    continue
-
-                ###############
-                # 3-bis. set metadata (dataobject)
-                for i in range(MAX_RETRIES):
-                    try:
-                        start_timeout(TIMEOUT)
-                        content = {}
-                        for key in md.keys:
-                            value = element.get(key, "***MISSING***")
-                            content[key] = value
-                        content["PID"] = PID
-
-                        metadata_file = ifile + ".meta"
-                        imain.create_empty(metadata_file, ignore_existing=True)
-                        imain.write_file_content(metadata_file, json.dumps(content))
-                        log.debug("Metadata dumped in {}", metadata_file)
-                        stop_timeout()
-                        break
-                    except BaseException as e:
-                        log.error(e)
-                        time.sleep(SLEEP_TIME)
-                        continue
+                    failures.append(ErrorCodes.UNABLE_TO_ASSIGN_PID)
                 else:
+                    log.info("PID: {}", job["pid"])
+                    failures.append(None)
+            return failures
+
+        ###############
+        # 3. set metadata (icat and dataobject)
+        def set_metadata(
+            imain: irods.IrodsPythonExt, jobs: List[Job]
+        ) -> List[Optional[Tuple[str, str]]]:
+            failures: List[Optional[Tuple[str, str]]] = []
+            for job in jobs:
+                element = job["element"]
+                ifile = job["ifile"]
+                # Remove me in a near future
+                try:
+                    metadata = {
+                        key: element.get(key, "***MISSING***") for key in md.keys
+                    }
+                    imain.set_metadata_bulk(ifile, metadata, skip_existing=True)
+                    log.debug("Metadata set for {}", ifile)
+
+                    # 3-bis. set metadata (dataobject)
+                    content = metadata.copy()
+                    content["PID"] = job["pid"]
+
+                    metadata_file = ifile + ".meta"
+                    imain.create_empty(metadata_file, ignore_existing=True)
+                    imain.write_file_content(metadata_file, json.dumps(content))
+                    log.debug("Metadata dumped in {}", metadata_file)
+                    failures.append(None)
+                except BaseException as e:
+                    log.error(e)
                     # failed metadata setting
-                    errors.append(
-                        {
-                            "error": ErrorCodes.UNABLE_TO_SET_METADATA[0],
-                            "description": ErrorCodes.UNABLE_TO_SET_METADATA[1],
-                            "subject": record_id,
-                        }
-                    )
+                    failures.append(ErrorCodes.UNABLE_TO_SET_METADATA)
+            return failures
+
+        jobs: List[Job] = []
+        for index, element in enumerate(elements):
+            temp_id = element.get("temp_id")  # do not pop
+            local_element = local_path.joinpath(temp_id)
+            # it is not equal to temp_id !?
+            current_file_name = local_element.name
+            jobs.append(
+                {
+                    "index": index,
+                    "element": element,
+                    "local": local_element,
+                    "ifile": str(Path(cloud_path, current_file_name)),
+                    "pid": None,
+                }
+            )
 
-                    self.update_state(
-                        state="PROGRESS",
-                        meta={"total": total, "step": counter, "errors": len(errors)},
-                    )
-                    continue
+        # A file is copied while the previous ones get their PIDs and metadata
+        stages = [
+            Stage("upload", upload, workers=PRODUCTION_WORKERS),
+            Stage("pid", request_pids, workers=PID_WORKERS, batch_size=PID_BATCH_SIZE),
+            Stage("metadata", set_metadata, workers=PRODUCTION_WORKERS),
+        ]
+        for job, stage, failure in run_pipeline(jobs, stages):
+            element = job["element"]
+            if stage is not None:
+                error = failure if isinstance(failure, tuple) else STAGE_ERRORS[stage]
+                errors.append(
+                    {
+                        "error": error[0],
+                        "description": error[1],
+                        "subject": element.get("format_n_code"),
+                    }
+                )
+            else:
                 ###############
                 # 4. remove the batch file?
                 # or move it into a "completed/" folder
@@ -235,33 +197,37 @@ def move_to_production_task(
 
                 ###############
                 # 5. add to logs
-                element["pid"] = PID
-                out_data.append(element)
-
+                element["pid"] = job["pid"]
+                out_data.append((job["index"], element))
                 counter += 1
-                self.update_state(
-                    state="PROGRESS",
-                    meta={"total": total, "step": counter, "errors": len(errors)},
-                )
 
-            ###############
-            # Notify the CDI API
-            myjson[param_key]["pids"] = out_data
-            msg = prepare_message(self, get_json=True)
-            for key, value in msg.items():
-                myjson[key] = value
-            if len(errors) > 0:
-                myjson["errors"] = errors
-            ret = ext_api.post(myjson, backdoor=backdoor)
-            log.info("CDI IM CALL = {}", ret)
+            self.update_state(
+                state="PROGRESS",
+                meta={"total": total, "step": counter, "errors": len(errors)},
+            )
 
-            out = {
-                "total": total,
-                "step": counter,
-                "errors": len(errors),
-                "out": out_data,
-            }
-            self.update_state(state="COMPLETED", meta=out)
+        # completed in any order, reported in the input order
+        completed = [element for _, element in sorted(out_data, key=lambda e: e[0])]
+
+        ###############
+        # Notify the CDI API
+        myjson[param_key]["pids"] = completed
+        msg = prepare_message(self, get_json=True)
+        for key, value in msg.items():
+            myjson[key] = value
+        if len(errors) > 0:
+            myjson["errors"] = errors
+        ret = ext_api.post(myjson, backdoor=backdoor)
+        log.info("CDI IM CALL = {}", ret)
+
+        out = {
+            "total": total,
+            "step": counter,
+            "errors": len(errors),
+            "out": completed,
+        }
+        self.update_state(state="COMPLETED", meta=out)
+        log.info("iRODS operations: {}", retry_policy.metrics.snapshot())
     except BaseException as e:
         log.error(e)
         log.error(type(e))
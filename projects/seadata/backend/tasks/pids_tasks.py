@@ -1,27 +1,15 @@
-import os
-from pathlib import Path
-from typing import Dict, List
+from typing import Any, Dict, List, Tuple
 
 from restapi.connectors import redis
 from restapi.connectors.celery import CeleryExt, Task
 from restapi.utilities.logs import log
 from restapi.utilities.processes import start_timeout, stop_timeout
 from seadata.connectors import irods
+from seadata.connectors.pids_cache import PIDCache
 
 TIMEOUT = 1800
-
-
-def recursive_list_files(imain: irods.IrodsPythonExt, irods_path: str) -> List[str]:
-
-    data: List[str] = []
-    for current in imain.list(irods_path):
-        ifile = str(Path(irods_path, current))
-        if imain.is_dataobject(ifile):
-            data.append(ifile)
-        else:
-            data.extend(recursive_list_files(imain, ifile))
-
-    return data
+# PIDs written to the cache with each redis pipeline
+CACHE_BATCH_SIZE = 1000
 
 
 @CeleryExt.task(idempotent=False)
@@ -38,93 +26,62 @@ def cache_batch_pids(
         "errors": 0,
     }
 
-    r = redis.get_instance().r
+    cache = PIDCache(redis.get_instance().r)
+
+    def flush(batch: List[Tuple[str, str]]) -> None:
+        # PIDs already cached are only counted as skipped
+        created = cache.store({pid: ifile for ifile, pid in batch})
+        stats["cached"] += created
+        stats["skipped"] += len(batch) - created
+        log.debug("{} files processed", stats["total"])
+        self.update_state(state="PROGRESS", meta=stats)
+        batch.clear()
+
     with irods.get_instance() as imain:
 
         try:
             start_timeout(TIMEOUT)
-            data = recursive_list_files(imain, irods_path)
-            log.info("Found {} files", len(data))
+            batch: List[Tuple[str, str]] = []
+            # PIDs are harvested with the file list, not with a request per file
+            for ifile, _, _, pid in imain.iterate_files(irods_path):
+
+                stats["total"] += 1
+                if pid is None:
+                    stats["errors"] += 1
+                    log.warning(
+                        "{}: file {} has not a PID assigned", stats["total"], ifile
+                    )
+                    continue
+
+                batch.append((ifile, pid))
+                if len(batch) >= CACHE_BATCH_SIZE:
+                    flush(batch)
+
+            if batch:
+                flush(batch)
             stop_timeout()
         except BaseException as e:
             log.error(e)
 
-        for ifile in data:
-
-            stats["total"] += 1
-
-            pid = r.get(ifile)
-            if pid is not None:
-                stats["skipped"] += 1
-                log.debug(
-                    "{}: file {} already cached with PID: {}",
-                    stats["total"],
-                    ifile,
-                    pid,
-                )
-                self.update_state(state="PROGRESS", meta=stats)
-                continue
-
-            try:
-                start_timeout(TIMEOUT)
-                metadata = imain.get_metadata(ifile)
-                pid = metadata.get("PID")
-                stop_timeout()
-            except BaseException as e:
-                log.error(e)
-
-            if pid is None:
-                stats["errors"] += 1
-                log.warning(
-                    "{}: file {} has not a PID assigned",
-                    stats["total"],
-                    ifile,
-                    pid,
-                )
-                self.update_state(state="PROGRESS", meta=stats)
-                continue
-
-            r.set(pid, ifile)
-            r.set(ifile, pid)
-            log.debug("{}: file {} cached with PID {}", stats["total"], ifile, pid)
-            stats["cached"] += 1
-            self.update_state(state="PROGRESS", meta=stats)
-
         self.update_state(state="COMPLETED", meta=stats)
         log.info(stats)
     return stats
 
 
 @CeleryExt.task(idempotent=False)
-def inspect_pids_cache(self: Task[[], None]) -> None:
+def inspect_pids_cache(self: Task[[], Dict[str, Any]]) -> Dict[str, Any]:
 
     log.info("Inspecting cache...")
-    counter = 0
-    cache: Dict[str, Dict[str, int]] = {}
-    r = redis.get_instance().r
-
-    for key in r.scan_iter("*"):
-        folder = os.path.dirname(r.get(key))
-
-        prefix = str(key).split("/")[0]
-        if prefix not in cache:
-            cache[prefix] = {}
-
-        if folder not in cache[prefix]:
-            cache[prefix][folder] = 1
-        else:
-            cache[prefix][folder] += 1
-
-        counter += 1
-        if counter % 10000 == 0:
-            log.info("{} pids inspected...", counter)
-
-    for prefix in cache:
-        for pid_path in cache[prefix]:
-            log.info(
-                "{} pids with prefix {} from path: {}",
-                cache[prefix][pid_path],
-                prefix,
-                pid_path,
-            )
-    log.info("Total PIDs found: {}", counter)
+    cache = PIDCache(redis.get_instance().r)
+    stats = cache.audit()
+
+    for folder, counter in sorted(stats["folders"].items()):
+        log.info("{} pids from path: {}", counter, folder)
+    for prefix, counter in sorted(stats["prefixes"].items()):
+        log.info("{} pids with prefix {}", counter, prefix)
+    log.info(
+        "Total PIDs found: {} ({} legacy keys migrated)",
+        stats["total"],
+        stats["legacy"],
+    )
+    return stats
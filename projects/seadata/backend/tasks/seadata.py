@@ -2,14 +2,41 @@
 from typing import Any, Dict, Optional, Tuple
 
 from restapi.connectors.celery import CeleryExt, Task
+from restapi.env import Env
 from restapi.utilities.logs import log
 from seadata.connectors.b2handle import PIDgenerator
-from seadata.endpoints import ImportManagerAPI
+from seadata.endpoints import ImportManagerAPI, seadata_vars
 
 # Size in bytes
 # TODO: move me into the configuration
 MAX_ZIP_SIZE = 2147483648  # 2 gb
 
+# Max number of concurrent b2handle lookups when resolving order PIDs
+PID_RESOLUTION_WORKERS = Env.to_int(seadata_vars.get("pid_resolution_workers"), 16)
+
+# Number of paths sent to a single PID minting rule
+PID_BATCH_SIZE = Env.to_int(seadata_vars.get("pid_batch_size"), 100)
+# Max number of PID minting rules concurrently executed (one session each)
+PID_WORKERS = Env.to_int(seadata_vars.get("pid_workers"), 2)
+
+# Max number of files concurrently copied (and annotated) in production
+PRODUCTION_WORKERS = Env.to_int(seadata_vars.get("production_workers"), 4)
+
+# Max number of data objects concurrently copied from iRODS (one session each)
+FETCH_WORKERS = Env.to_int(seadata_vars.get("fetch_workers"), 4)
+# Number of attempts for each data object copied from iRODS
+FETCH_RETRIES = 3
+
+# Size in bytes of the chunks read when downloading the partners files
+DOWNLOAD_CHUNK_SIZE = Env.to_int(seadata_vars.get("download_chunk_size"), 8388608)
+# Number of byte ranges concurrently downloaded, if allowed by the server
+DOWNLOAD_SEGMENTS = Env.to_int(seadata_vars.get("download_segments"), 1)
+# Number of attempts to complete an interrupted download
+DOWNLOAD_RETRIES = 3
+
+# Also verify the CRC of every entry of the downloaded zips (reads all the data)
+ZIP_CRC_CHECK = Env.to_bool(seadata_vars.get("zip_crc_check"))
+
 ext_api = ImportManagerAPI()
 
 #####################
@@ -0,0 +1,34 @@
+from restapi.connectors import redis
+from restapi.connectors.celery import CeleryExt, Task
+from restapi.utilities.logs import log
+from seadata.connectors import irods
+from seadata.connectors.irods.retry import RETRYABLE_ERRORS
+from seadata.connectors.order_downloads import OrderDownloads
+from seadata.endpoints import ORDER_DOWNLOAD_TTL
+
+
+@CeleryExt.task(idempotent=True)
+def sweep_order_tickets(self: Task[[], int]) -> int:
+    """Revoke the expired tickets of the orders download links"""
+
+    downloads = OrderDownloads(redis.get_instance().r, ORDER_DOWNLOAD_TTL)
+    codes = downloads.get_expired_tickets()
+    log.info("{} expired tickets to be revoked", len(codes))
+
+    forgotten = []
+    with irods.get_instance() as imain:
+        for code in codes:
+            try:
+                imain.delete_ticket(code)
+            except RETRYABLE_ERRORS as e:
+                # kept for the next sweep
+                log.warning("Cannot revoke ticket {}: {}", code, e)
+                continue
+            except BaseException as e:
+                # already removed, e.g. together with the order
+                log.debug("Ticket {} not revoked: {}", code, e)
+            forgotten.append(code)
+
+    downloads.forget_tickets(forgotten)
+    log.info("{} expired tickets removed", len(forgotten))
+    return len(forgotten)
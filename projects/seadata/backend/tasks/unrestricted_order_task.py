@@ -1,23 +1,33 @@
 import logging
 import os
-import re
+from io import BytesIO
 from pathlib import Path
-from shutil import make_archive, rmtree
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
-from plumbum import local  # type: ignore
-from plumbum.commands.processes import ProcessExecutionError  # type: ignore
 from restapi.connectors import redis
 from restapi.connectors.celery import CeleryExt, Task
 from restapi.utilities.logs import log
 from restapi.utilities.processes import start_timeout, stop_timeout
 from seadata.connectors import irods
 from seadata.connectors.b2handle import PIDgenerator, b2handle
+from seadata.connectors.irods.transfers import parallel_fetch
+from seadata.connectors.order_downloads import OrderDownloads
+from seadata.connectors.pids_cache import PIDCache
 from seadata.connectors.rabbit_queue import prepare_message
-from seadata.endpoints import MOUNTPOINT, ORDERS_DIR, ErrorCodes
-from seadata.tasks.seadata import MAX_ZIP_SIZE, ext_api, notify_error
+from seadata.endpoints import MOUNTPOINT, ORDER_DOWNLOAD_TTL, ORDERS_DIR, ErrorCodes
+from seadata.tasks.seadata import (
+    FETCH_RETRIES,
+    FETCH_WORKERS,
+    MAX_ZIP_SIZE,
+    PID_RESOLUTION_WORKERS,
+    ext_api,
+    notify_error,
+)
+from seadata.tasks.zip_utils import SplitZipWriter, ZipEntryTooLarge
 
 TIMEOUT = 1800
+# Files up to this size (in bytes) are fetched concurrently and kept in memory
+IN_MEMORY_FETCH_SIZE = 8388608  # 8 mb
 
 logging.getLogger("b2handle").setLevel(logging.WARNING)
 b2handle_client = b2handle.instantiate_for_read_access()
@@ -47,119 +57,126 @@ def unrestricted_order(
     ##################
     # SETUP
     local_dir = MOUNTPOINT.joinpath(ORDERS_DIR, order_id)
-    local_zip_dir = local_dir.joinpath("tobezipped")
-    local_zip_dir.mkdir(parents=True, exist_ok=True)
+    local_dir.mkdir(parents=True, exist_ok=True)
 
-    r = redis.get_instance().r
+    cache = PIDCache(redis.get_instance().r)
+    downloads = OrderDownloads(redis.get_instance().r, ORDER_DOWNLOAD_TTL)
     try:
         with irods.get_instance() as imain:
 
             log.info("Retrieving paths for {} PIDs", len(pids))
             ##################
             # Verify pids
-            files: Dict[str, Path] = {}
             errors: List[Dict[str, str]] = []
             counter = 0
-            verified = 0
-            for pid in pids:
 
-                ################
-                # avoid empty pids?
-                if "/" not in pid or len(pid) < 10:
-                    continue
-
-                ################
-                # Check the cache first
-                ifile = r.get(pid)
-                if ifile is not None:
-                    files[pid] = Path(ifile.decode())
-                    verified += 1
-                    self.update_state(
-                        state="PROGRESS",
-                        meta={
-                            "total": total,
-                            "step": counter,
-                            "verified": verified,
-                            "errors": len(errors),
-                        },
-                    )
-                    continue
-
-                # otherwise b2handle remotely
-                try:
-                    b2handle_output = b2handle_client.retrieve_handle_record(pid)
-                except BaseException:
-                    self.update_state(
-                        state="FAILED",
-                        meta={
-                            "total": total,
-                            "step": counter,
-                            "verified": verified,
-                            "errors": len(errors),
-                        },
-                    )
-                    return notify_error(
-                        ErrorCodes.B2HANDLE_ERROR, myjson, backdoor, self
-                    )
-
-                if b2handle_output is None:
-                    errors.append(
-                        {
-                            "error": ErrorCodes.PID_NOT_FOUND[0],
-                            "description": ErrorCodes.PID_NOT_FOUND[1],
-                            "subject": pid,
-                        }
-                    )
-                    self.update_state(
-                        state="PROGRESS",
-                        meta={"total": total, "step": counter, "errors": len(errors)},
-                    )
-
-                    log.warning("PID not found: {}", pid)
-                else:
-                    pid_path = pmaker.parse_pid_dataobject_path(b2handle_output)
-
-                    if not pid_path:
-                        log.error("Can't extract a PID from {}", b2handle_output)
-                    else:
-                        log.debug("PID verified: {}\n({})", pid, pid_path)
-                        files[pid] = pid_path
-                        r.set(pid, str(pid_path))
-                        r.set(str(pid_path), pid)
-
-                        verified += 1
-                        self.update_state(
-                            state="PROGRESS",
-                            meta={
-                                "total": total,
-                                "step": counter,
-                                "verified": verified,
-                                "errors": len(errors),
-                            },
-                        )
+            # avoid empty pids?
+            valid_pids = [pid for pid in pids if "/" in pid and len(pid) >= 10]
+
+            # Cache hits first, then b2handle remotely
+            try:
+                files, not_found = pmaker.resolve_pids(
+                    cache, b2handle_client, valid_pids, workers=PID_RESOLUTION_WORKERS
+                )
+            except BaseException as e:
+                log.error(e)
+                self.update_state(
+                    state="FAILED",
+                    meta={
+                        "total": total,
+                        "step": counter,
+                        "verified": 0,
+                        "errors": len(errors),
+                    },
+                )
+                return notify_error(ErrorCodes.B2HANDLE_ERROR, myjson, backdoor, self)
+
+            for pid in not_found:
+                errors.append(
+                    {
+                        "error": ErrorCodes.PID_NOT_FOUND[0],
+                        "description": ErrorCodes.PID_NOT_FOUND[1],
+                        "subject": pid,
+                    }
+                )
+
+            verified = len(files)
+            self.update_state(
+                state="PROGRESS",
+                meta={
+                    "total": total,
+                    "step": counter,
+                    "verified": verified,
+                    "errors": len(errors),
+                },
+            )
             log.info("Retrieved paths for {} PIDs", len(files))
 
             # Recover files
-            for pid, ipath in files.items():
-
-                # Copy files from irods into a local TMPDIR
-                filename = ipath.name
-                local_file = local_zip_dir.joinpath(filename)
-
-                if not local_file.exists() or local_file.stat().st_size == 0:
+            # Data objects are zipped while they are read from irods,
+            # without a local copy. Small files are fetched concurrently
+            # and kept in memory, larger files are streamed into the zip
+            # by the main session
+            def fetch(
+                icom: irods.IrodsPythonExt, pid: str, ipath: Path
+            ) -> Tuple[int, Optional[bytes]]:
+                obj = icom.get_dataobject(ipath)
+                if obj.size > IN_MEMORY_FETCH_SIZE:
+                    return obj.size, None
+                with obj.open("r") as source:
+                    return obj.size, source.read()
+
+            def add_to_zip(zip_writer: SplitZipWriter, ipath: Path) -> None:
+                for attempt in range(1, FETCH_RETRIES + 1):
                     try:
-                        start_timeout(TIMEOUT)
-                        with imain.get_dataobject(ipath).open("r") as source:
-                            with open(local_file, "wb") as target:
-                                chunk_size = 10485760
-                                while True:
-                                    data = source.read(chunk_size)
-                                    if not data:
-                                        break
-                                    target.write(data)
-                        stop_timeout()
+                        obj = imain.get_dataobject(ipath)
+                        with obj.open("r") as source:
+                            zip_writer.add_stream(ipath.name, source, size=obj.size)
+                        return
                     except BaseException as e:
-                        log.error(e)
+                        if attempt >= FETCH_RETRIES:
+                            raise e
+                        log.warning("Failed to stream {} ({}), retrying", ipath, e)
+
+            zip_local_file = local_dir.joinpath(zip_file_name)
+            log.debug("Zip local path: {}", zip_local_file)
+            base_filename, _ = os.path.splitext(zip_file_name)
+
+            # Zip parts are created while files are added, a new part is
+            # started when the next file would exceed the max zip size
+            log.info("Zipping {} files with {} workers", len(files), FETCH_WORKERS)
+            with SplitZipWriter(local_dir, base_filename, MAX_ZIP_SIZE) as zip_writer:
+                for pid, ipath, fetched, error in parallel_fetch(
+                    files, fetch, workers=FETCH_WORKERS, retries=FETCH_RETRIES
+                ):
+
+                    filename = ipath.name
+                    if error is None and fetched is not None:
+                        size, data = fetched
+                        # A file with the same name is already in the zip
+                        if filename in zip_writer.names:
+                            log.warning("{} already zipped, skipping {}", filename, pid)
+                        else:
+                            try:
+                                if data is None:
+                                    add_to_zip(zip_writer, ipath)
+                                else:
+                                    zip_writer.add_stream(
+                                        filename, BytesIO(data), size=size
+                                    )
+                            except ZipEntryTooLarge as e:
+                                return notify_error(
+                                    ErrorCodes.ZIP_SPLIT_ENTRY_TOO_LARGE,
+                                    myjson,
+                                    backdoor,
+                                    self,
+                                    extra=str(e),
+                                )
+                            except BaseException as e:
+                                error = e
+
+                    if error is not None:
+                        log.error("Unable to download {}: {}", ipath, error)
                         errors.append(
                             {
                                 "error": ErrorCodes.UNABLE_TO_DOWNLOAD_FILE[0],
@@ -173,49 +190,33 @@ def unrestricted_order(
                             meta={
                                 "total": total,
                                 "step": counter,
+                                "verified": verified,
                                 "errors": len(errors),
                             },
                         )
                         continue
 
-                    # log.debug("Copy to local: {}", local_file)
-                #########################
-                #########################
-
-                counter += 1
-                if counter % 1000 == 0:
-                    self.update_state(
-                        state="PROGRESS",
-                        meta={
-                            "total": total,
-                            "step": counter,
-                            "verified": verified,
-                            "errors": len(errors),
-                        },
-                    )
-                    log.info("{} pids already processed", counter)
-                # # Set current file to the metadata collection
-                # if pid not in metadata:
-                #     md = {pid: ipath}
-                #     imain.set_metadata(order_path, **md)
-                #     log.debug("Set metadata")
+                    counter += 1
+                    if counter % 1000 == 0:
+                        self.update_state(
+                            state="PROGRESS",
+                            meta={
+                                "total": total,
+                                "step": counter,
+                                "verified": verified,
+                                "errors": len(errors),
+                            },
+                        )
+                        log.info("{} pids already processed", counter)
 
             zip_ipath = None
-            if counter > 0:
-                ##################
-                # Zip the dir
-                zip_local_file = local_dir.joinpath(zip_file_name)
-                log.debug("Zip local path: {}", zip_local_file)
-                if not zip_local_file.exists() or zip_local_file.stat().st_size == 0:
-                    make_archive(
-                        base_name=str(
-                            zip_local_file.parent.joinpath(zip_local_file.stem)
-                        ),
-                        format="zip",
-                        root_dir=local_zip_dir,
-                    )
-
-                    log.info("Compressed in: {}", zip_local_file)
+            if counter == 0:
+                for part in zip_writer.parts:
+                    part.unlink(missing_ok=True)
+            elif len(zip_writer.parts) == 1:
+                # Everything fits in one zip, no need to split
+                zip_writer.parts[0].replace(zip_local_file)
+                log.info("Compressed in: {}", zip_local_file)
 
                 ##################
                 # Copy the zip into irods
@@ -226,96 +227,43 @@ def unrestricted_order(
                     imain.put(str(zip_local_file), str(zip_ipath))
                     log.info("Copied zip to irods: {}", zip_ipath)
                     stop_timeout()
+                    # links issued for a previous version of the zip are stale
+                    downloads.forget(order_id, zip_local_file.name)
+                    downloads.set_local_copy(order_id, zip_local_file)
                 except BaseException as e:
                     log.error(e)
                     return notify_error(
                         ErrorCodes.UNEXPECTED_ERROR, myjson, backdoor, self
                     )
-
-                if os.path.getsize(str(zip_local_file)) > MAX_ZIP_SIZE:
-                    log.warning("Zip too large, splitting {}", zip_local_file)
-
-                    # Create a sub folder for split files. If already exists,
-                    # remove it before to start from a clean environment
-                    split_path = local_dir.joinpath("unrestricted_zip_split")
-                    rmtree(str(split_path), ignore_errors=True)
-                    split_path.mkdir()
-
-                    # Execute the split of the whole zip
-                    split_params = [
-                        "-n",
-                        MAX_ZIP_SIZE,
-                        "-b",
-                        str(split_path),
-                        zip_local_file,
-                    ]
+            else:
+                log.info(
+                    "Compressed in {} zip files: {}",
+                    len(zip_writer.parts),
+                    local_dir.joinpath(f"{base_filename}*.zip"),
+                )
+
+                for subzip_path in zip_writer.parts:
+                    subzip_ipath = Path(order_path, subzip_path.name)
+                    if zip_ipath is None:
+                        zip_ipath = subzip_ipath
+
+                    log.info("Uploading {} -> {}", subzip_path, subzip_ipath)
                     try:
-                        zipsplit = local["/usr/bin/zipsplit"]
-                        zipsplit(split_params)
-                    except ProcessExecutionError as e:
-
-                        if "Entry is larger than max split size" in e.stdout:
-                            reg = r"Entry too big to split, read, or write \((.*)\)"
-                            extra = None
-                            m = re.search(reg, e.stdout)
-                            if m:
-                                extra = m.group(1)
-                            return notify_error(
-                                ErrorCodes.ZIP_SPLIT_ENTRY_TOO_LARGE,
-                                myjson,
-                                backdoor,
-                                self,
-                                extra=extra,
-                            )
-                        else:
-                            log.error(e.stdout)
-
+                        start_timeout(TIMEOUT)
+                        imain.put(str(subzip_path), str(subzip_ipath))
+                        stop_timeout()
+                        downloads.forget(order_id, subzip_path.name)
+                        downloads.set_local_copy(order_id, subzip_path)
+                    except BaseException as e:
+                        log.error(e)
                         return notify_error(
-                            ErrorCodes.ZIP_SPLIT_ERROR,
+                            ErrorCodes.UNEXPECTED_ERROR,
                             myjson,
                             backdoor,
                             self,
-                            extra=str(zip_local_file),
+                            extra=str(subzip_path),
                         )
 
-                    regexp = "^.*[^0-9]([0-9]+).zip$"
-                    zip_files = os.listdir(split_path)
-                    base_filename, _ = os.path.splitext(zip_file_name)
-                    for subzip_file in zip_files:
-                        m = re.search(regexp, subzip_file)
-                        if not m:
-                            log.error(
-                                "Cannot extract index from zip name: {}",
-                                subzip_file,
-                            )
-                            return notify_error(
-                                ErrorCodes.INVALID_ZIP_SPLIT_OUTPUT,
-                                myjson,
-                                backdoor,
-                                self,
-                                extra=str(zip_local_file),
-                            )
-                        index = m.group(1).lstrip("0")
-                        subzip_path = split_path.joinpath(subzip_file)
-
-                        subzip_ifile = f"{base_filename}{index}.zip"
-                        subzip_ipath = Path(order_path, subzip_ifile)
-
-                        log.info("Uploading {} -> {}", subzip_path, subzip_ipath)
-                        try:
-                            start_timeout(TIMEOUT)
-                            imain.put(str(subzip_path), str(subzip_ipath))
-                            stop_timeout()
-                        except BaseException as e:
-                            log.error(e)
-                            return notify_error(
-                                ErrorCodes.UNEXPECTED_ERROR,
-                                myjson,
-                                backdoor,
-                                self,
-                                extra=str(subzip_path),
-                            )
-
             #########################
             # NOTE: should I close the iRODS session ?
             #########################
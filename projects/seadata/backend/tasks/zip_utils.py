@@ -0,0 +1,293 @@
+"""
+Zip files utilities shared by the orders tasks
+"""
+import time
+import zipfile
+from pathlib import Path, PurePosixPath
+from shutil import copyfileobj
+from types import TracebackType
+from typing import BinaryIO, List, Optional, Set, Type
+
+from restapi.utilities.logs import log
+
+CHUNK_SIZE = 10485760
+
+# Upper bound of the bytes added by an entry besides its data: local header,
+# data descriptor and central directory record, with zip64 extra fields.
+# The file name is added twice (local header and central directory)
+ENTRY_OVERHEAD = 256
+# End of central directory records (including zip64 end record and locator)
+END_RECORDS_SIZE = 22 + 56 + 20
+
+# These files are already compressed, deflating them again only wastes CPU
+COMPRESSED_EXTENSIONS = {
+    ".7z",
+    ".bz2",
+    ".gz",
+    ".jpeg",
+    ".jpg",
+    ".png",
+    ".rar",
+    ".tgz",
+    ".xz",
+    ".zip",
+}
+
+
+class StreamingZipWriter:
+    """
+    Write zip entries directly from (iRODS) read streams,
+    without staging a local copy of the files
+    """
+
+    def __init__(self, path: Path, compression: int = zipfile.ZIP_DEFLATED) -> None:
+        self.path = path
+        self.compression = compression
+        self.names: Set[str] = set()
+        self.zip = zipfile.ZipFile(path, "w", compression=compression, allowZip64=True)
+
+    def __enter__(self) -> "StreamingZipWriter":
+        return self
+
+    def __exit__(
+        self,
+        exctype: Optional[Type[BaseException]],
+        excinst: Optional[BaseException],
+        exctb: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+    @property
+    def entries(self) -> int:
+        return len(self.names)
+
+    def get_compression(self, arcname: str, stored: Optional[bool] = None) -> int:
+        if stored is None:
+            stored = Path(arcname).suffix.lower() in COMPRESSED_EXTENSIONS
+        return zipfile.ZIP_STORED if stored else self.compression
+
+    def add_stream(
+        self,
+        arcname: str,
+        source: BinaryIO,
+        size: Optional[int] = None,
+        stored: Optional[bool] = None,
+    ) -> None:
+        """
+        Copy the source stream into a new entry of the archive.
+        Stored (not compressed) entries are used when requested or when the
+        file extension reveals already compressed data.
+        If the copy fails the partial entry is removed from the archive
+        """
+
+        info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+        info.compress_type = self.get_compression(arcname, stored)
+        info.external_attr = 0o644 << 16
+        if size is not None:
+            info.file_size = size
+
+        offset = self.zip.fp.tell()  # type: ignore
+        try:
+            with self.zip.open(info, "w", force_zip64=size is None) as target:
+                copyfileobj(source, target, CHUNK_SIZE)
+        except BaseException:
+            self.rollback(arcname, offset)
+            raise
+
+        self.names.add(arcname)
+
+    def rollback(self, arcname: str, offset: int) -> None:
+        """Drop a partially written entry, truncating the archive at its offset"""
+        log.warning("Removing partial entry {} from {}", arcname, self.path)
+        if self.zip.filelist and self.zip.filelist[-1].filename == arcname:
+            self.zip.filelist.pop()
+            self.zip.NameToInfo.pop(arcname, None)
+        fp = self.zip.fp
+        fp.seek(offset)  # type: ignore
+        fp.truncate()  # type: ignore
+        # where the central directory will be written on close
+        self.zip.start_dir = offset  # type: ignore
+
+    def close(self) -> None:
+        self.zip.close()
+
+
+class ZipEntryTooLarge(Exception):
+    """A single entry does not fit into a zip part"""
+
+    def __init__(self, arcname: str, size: int) -> None:
+        super().__init__(f"{arcname} ({size} bytes)")
+        self.arcname = arcname
+        self.size = size
+
+
+class SplitZipWriter:
+    """
+    Write entries into a sequence of zip files, each one of at most
+    max_size bytes, named <base_name><index>.zip (index starting from
+    first_index, 1 by default).
+    A new part is started when the next entry could exceed the limit.
+    Every part is a complete zip archive that can be opened on its own,
+    a last part left with no entries is removed on close
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        base_name: str,
+        max_size: int,
+        compression: int = zipfile.ZIP_DEFLATED,
+        first_index: int = 1,
+    ) -> None:
+        self.directory = directory
+        self.base_name = base_name
+        self.max_size = max_size
+        self.compression = compression
+        self.first_index = first_index
+        self.names: Set[str] = set()
+        self.parts: List[Path] = []
+        self.writer: Optional[StreamingZipWriter] = None
+        # size of the central directory of the current part
+        self.cd_size = 0
+
+    def __enter__(self) -> "SplitZipWriter":
+        return self
+
+    def __exit__(
+        self,
+        exctype: Optional[Type[BaseException]],
+        excinst: Optional[BaseException],
+        exctb: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+    @property
+    def entries(self) -> int:
+        return len(self.names)
+
+    def new_part(self) -> StreamingZipWriter:
+        if self.writer:
+            self.writer.close()
+        path = self.directory.joinpath(
+            f"{self.base_name}{self.first_index + len(self.parts)}.zip"
+        )
+        log.debug("New zip part: {}", path)
+        self.parts.append(path)
+        self.writer = StreamingZipWriter(path, compression=self.compression)
+        self.cd_size = 0
+        return self.writer
+
+    def part_size(self, writer: StreamingZipWriter) -> int:
+        return writer.zip.fp.tell() + self.cd_size + END_RECORDS_SIZE  # type: ignore
+
+    def add_stream(
+        self,
+        arcname: str,
+        source: BinaryIO,
+        size: int,
+        stored: Optional[bool] = None,
+    ) -> None:
+        """
+        Add an entry of the given (uncompressed) size, rolling over to a new
+        part when the entry could exceed the max size of the current one.
+        Raise ZipEntryTooLarge if the entry does not fit even in an empty part
+        """
+
+        writer = self.writer or self.new_part()
+
+        compress_type = writer.get_compression(arcname, stored)
+        # the worst case of deflate slightly expands incompressible data
+        bound = size + ENTRY_OVERHEAD + 2 * len(arcname.encode())
+        if compress_type != zipfile.ZIP_STORED:
+            bound += size // 1000
+
+        # Stored data cannot shrink, no reason to even try
+        if compress_type == zipfile.ZIP_STORED:
+            if bound + END_RECORDS_SIZE > self.max_size:
+                raise ZipEntryTooLarge(arcname, size)
+
+        # an empty part (e.g. after a failed entry) is filled before a new one
+        if writer.entries > 0 and self.part_size(writer) + bound > self.max_size:
+            writer = self.new_part()
+
+        offset = writer.zip.fp.tell()  # type: ignore
+        writer.add_stream(arcname, source, size=size, stored=stored)
+        self.cd_size += ENTRY_OVERHEAD // 2 + len(arcname.encode())
+
+        # Can only happen to a compressed entry alone in its part
+        if self.part_size(writer) > self.max_size:
+            writer.names.discard(arcname)
+            writer.rollback(arcname, offset)
+            self.cd_size -= ENTRY_OVERHEAD // 2 + len(arcname.encode())
+            raise ZipEntryTooLarge(arcname, size)
+
+        self.names.add(arcname)
+
+    def close(self) -> None:
+        if self.writer:
+            self.writer.close()
+            if self.writer.entries == 0:
+                log.debug("Removing empty zip part: {}", self.writer.path)
+                self.writer.path.unlink(missing_ok=True)
+                self.parts.remove(self.writer.path)
+            self.writer = None
+
+
+def split_zip(
+    source: Path,
+    directory: Path,
+    base_name: str,
+    max_size: int,
+    first_index: int = 1,
+) -> List[Path]:
+    """
+    Split an existing zip into parts of at most max_size bytes.
+    Entries are re-written one by one, no external binary is required
+    """
+
+    with zipfile.ZipFile(source, "r") as zip_ref:
+        with SplitZipWriter(
+            directory, base_name, max_size, first_index=first_index
+        ) as writer:
+            for info in zip_ref.infolist():
+                if info.is_dir():
+                    continue
+                with zip_ref.open(info, "r") as entry:
+                    writer.add_stream(
+                        info.filename,
+                        entry,  # type: ignore
+                        size=info.file_size,
+                        stored=info.compress_type == zipfile.ZIP_STORED,
+                    )
+    return writer.parts
+
+
+def count_zip_entries(path: Path, check_crc: bool = False) -> int:
+    """
+    Validate a zip from its central directory, without extracting it.
+    Return the number of entries in the root of the archive, i.e. the files
+    (or folders) that would be created by extracting it.
+    Raise zipfile.BadZipFile for unsafe names, entries exceeding the archive
+    and, if check_crc is set, for corrupted data (streamed, never written)
+    """
+
+    archive_size = path.stat().st_size
+    names: Set[str] = set()
+    with zipfile.ZipFile(path, "r") as zip_ref:
+        for info in zip_ref.infolist():
+            name = info.filename
+            parts = PurePosixPath(name.replace("\\", "/")).parts
+            if not parts or parts[0] == "/" or ".." in parts:
+                raise zipfile.BadZipFile(f"Unsafe entry name: {name}")
+
+            if info.header_offset + info.compress_size > archive_size:
+                raise zipfile.BadZipFile(f"Entry exceeds the archive size: {name}")
+
+            names.add(parts[0])
+
+        if check_crc:
+            corrupted = zip_ref.testzip()
+            if corrupted is not None:
+                raise zipfile.BadZipFile(f"Bad CRC for entry: {corrupted}")
+
+    return len(names)
@@ -0,0 +1,162 @@
+import hashlib
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Thread
+from typing import Any, Dict, Iterator, List, Optional
+
+import pytest
+from seadata.tasks import downloader
+from seadata.tasks.downloader import (
+    DownloadSizeExceeded,
+    PartialDownload,
+    download_file,
+)
+from tests.custom import SeadataTests
+
+CONTENT = os.urandom(300_000)
+ETAG = '"v1"'
+
+
+class PartnerHandler(BaseHTTPRequestHandler):
+    """A partner server, with optional support of ranges and a broken transfer"""
+
+    protocol_version = "HTTP/1.1"
+    ranges = True
+    # bytes sent before dropping the connection, on the first GET only
+    fail_after: Optional[int] = None
+    requests: List[Dict[str, Any]] = []
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_HEAD(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(CONTENT)))
+        self.send_header("ETag", ETAG)
+        if self.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self) -> None:
+        headers = dict(self.headers)
+        PartnerHandler.requests.append(headers)
+
+        if PartnerHandler.fail_after is not None:
+            sent = CONTENT[: PartnerHandler.fail_after]
+            PartnerHandler.fail_after = None
+            # a chunked body never terminated, as a dropped connection
+            self.send_response(200)
+            self.send_header("ETag", ETAG)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.wfile.write(f"{len(sent):x}\r\n".encode() + sent + b"\r\n")
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        requested = headers.get("Range")
+        if_range = headers.get("If-Range")
+        if requested and self.ranges and if_range in (None, ETAG):
+            start, _, end = requested.replace("bytes=", "").partition("-")
+            first = int(start)
+            last = int(end) if end else len(CONTENT) - 1
+            if first >= len(CONTENT):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = CONTENT[first : last + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {first}-{last}/{len(CONTENT)}")
+        else:
+            body = CONTENT
+            self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def partner() -> Iterator[str]:
+    PartnerHandler.ranges = True
+    PartnerHandler.fail_after = None
+    PartnerHandler.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PartnerHandler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/partner.zip"
+    server.shutdown()
+    server.server_close()
+
+
+MD5 = hashlib.md5(CONTENT).hexdigest()
+
+
+class TestApp(SeadataTests):
+    def test_01(
+        self, partner: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+    ) -> None:
+
+        monkeypatch.setattr(downloader, "RETRY_WAIT", 0)
+        destination = tmp_path.joinpath("partner.zip")
+
+        # an interrupted transfer is resumed from the received data
+        PartnerHandler.fail_after = 100_000
+        size, checksum = download_file(partner, destination, segments=1)
+        assert (size, checksum) == (len(CONTENT), MD5)
+        assert destination.read_bytes() == CONTENT
+        assert not destination.with_name("partner.zip.part").exists()
+        assert not destination.with_name("partner.zip.part.json").exists()
+        resumed = PartnerHandler.requests[-1]
+        assert resumed["Range"] == "bytes=100000-"
+        assert resumed["If-Range"] == ETAG
+        assert resumed["Accept-Encoding"] == "identity"
+
+    def test_02(self, partner: str, tmp_path: Path) -> None:
+
+        destination = tmp_path.joinpath("partner.zip")
+
+        # data left by a previous task for a different version of the file
+        partial = PartialDownload(destination, partner)
+        partial.path.write_bytes(b"x" * 1000)
+        partial.reset('"v0"', len(CONTENT), [[0, None, 1000]])
+        assert PartialDownload(destination, partner).load()
+        assert not PartialDownload(destination, f"{partner}?other").load()
+
+        # the server ignores the range, the download starts again
+        size, checksum = download_file(partner, destination, segments=1)
+        assert (size, checksum) == (len(CONTENT), MD5)
+        assert PartnerHandler.requests[-1]["If-Range"] == '"v0"'
+        assert destination.read_bytes() == CONTENT
+
+    def test_03(self, partner: str, tmp_path: Path) -> None:
+
+        # byte ranges downloaded concurrently
+        destination = tmp_path.joinpath("partner.zip")
+        size, checksum = download_file(partner, destination, segments=4)
+        assert (size, checksum) == (len(CONTENT), MD5)
+        assert destination.read_bytes() == CONTENT
+        assert len(PartnerHandler.requests) == 4
+        assert all(r["If-Range"] == ETAG for r in PartnerHandler.requests)
+
+        # without ranges the file is downloaded in a single request
+        PartnerHandler.ranges = False
+        PartnerHandler.requests = []
+        destination = tmp_path.joinpath("no_ranges.zip")
+        size, checksum = download_file(partner, destination, segments=4)
+        assert (size, checksum) == (len(CONTENT), MD5)
+        assert len(PartnerHandler.requests) == 1
+        assert "Range" not in PartnerHandler.requests[0]
+
+    def test_04(self, partner: str, tmp_path: Path) -> None:
+
+        destination = tmp_path.joinpath("partner.zip")
+        for segments in (1, 4):
+            with pytest.raises(DownloadSizeExceeded):
+                download_file(
+                    partner, destination, max_size=len(CONTENT) - 1, segments=segments
+                )
+            assert not destination.exists()
+            assert not destination.with_name("partner.zip.part").exists()
@@ -0,0 +1,36 @@
+from faker import Faker
+from restapi.tests import FlaskClient
+from seadata.connectors import irods
+from tests.custom import SeadataTests
+
+
+class TestApp(SeadataTests):
+    def test_01(self, client: FlaskClient, faker: Faker) -> None:
+
+        with irods.get_instance() as imain:
+            path = f"{imain.get_user_home()}/{faker.pystr()}.txt"
+            imain.create_empty(path)
+
+            try:
+                imain.set_metadata(path, PID="21.T12995/a", EDMO_CODE="1234")
+                # as a retry after an add already applied by the server
+                imain.set_metadata(path, PID="21.T12995/a")
+                assert imain.has_metadata(path, {"PID": "21.T12995/a"})
+                assert not imain.has_metadata(path, {"PID": "21.T12995/b"})
+
+                imain.set_metadata_bulk(path, {"download": "url1", "code": "c1"})
+                imain.set_metadata_bulk(path, {"download": "url1", "code": "c1"})
+                assert imain.has_metadata(path, {"download": "url1", "code": "c1"})
+
+                imain.set_metadata_bulk(
+                    path, {"download": "url2"}, remove=["download", "code"]
+                )
+                metadata = imain.get_metadata(path)
+                assert metadata["download"] == "url2"
+                assert "code" not in metadata
+                assert metadata["PID"] == "21.T12995/a"
+
+                imain.set_metadata_bulk(path, {"PID": "other"}, skip_existing=True)
+                assert imain.get_metadata(path)["PID"] == "21.T12995/a"
+            finally:
+                imain.remove(path)
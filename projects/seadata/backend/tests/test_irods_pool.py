@@ -0,0 +1,78 @@
+import os
+
+import pytest
+from faker import Faker
+from seadata.connectors import irods
+from seadata.connectors.irods import IrodsPythonExt
+from tests.custom import SeadataTests
+
+
+class TestApp(SeadataTests):
+    def test_01(self, faker: Faker, monkeypatch: pytest.MonkeyPatch) -> None:
+
+        # sessions are not connected here, they are only moved in the pool
+        monkeypatch.setattr(IrodsPythonExt, "connect", lambda self, **kwargs: self)
+        pool = irods.pool
+        pool.clear()
+        credentials = {"user": faker.pystr(), "password": faker.pystr()}
+        key = pool.get_key({**irods.instance.variables, **credentials})
+
+        def checkout() -> IrodsPythonExt:
+            # neither verified nor expired, unless released after a failure
+            return pool.checkout(verification=3600, expiration=0, **credentials)
+
+        # released sessions are reused
+        obj = IrodsPythonExt()
+        obj.pool_key = key
+        obj.disconnected = False
+        with obj:
+            pass
+        assert obj.disconnected
+        assert [o for _, o in pool.idle[key]] == [obj]
+        assert checkout() is obj
+        assert not pool.idle[key]
+
+        # sessions released on an exception are closed instead
+        with pytest.raises(ValueError):
+            with obj:
+                raise ValueError("broken")
+        assert obj.broken
+        assert obj.pool_key is None
+        assert not pool.idle[key]
+        assert key in pool.failed
+
+        # after a failure the idle sessions are verified on every checkout
+        other = IrodsPythonExt()
+        other.pool_key = key
+        other.disconnected = False
+        other.disconnect()
+        assert [o for _, o in pool.idle[key]] == [other]
+        # not connected, so not healthy: closed and replaced by a new session
+        new = checkout()
+        assert new is not other
+        assert new.pool_key == key
+        assert not pool.idle[key]
+        assert other.pool_key is None
+        assert other.disconnected
+        new.close()
+
+        # outside of requests (e.g. in celery tasks) sessions come from the pool
+        with irods.get_instance(**credentials) as imain:
+            assert imain.pool_key == key
+        assert [o for _, o in pool.idle[key]] == [imain]
+        with irods.get_instance(**credentials) as reused:
+            assert reused is imain
+
+        # sessions inherited from the parent process are never reused
+        obj = IrodsPythonExt()
+        obj.pool_key = key
+        obj.disconnected = False
+        obj.disconnect()
+        assert pool.idle[key]
+        pool.pid = os.getpid() + 1
+        pool.check_fork()
+        assert not pool.idle
+        assert not pool.failed
+        assert pool.pid == os.getpid()
+
+        pool.clear()
@@ -0,0 +1,53 @@
+from faker import Faker
+from restapi.tests import FlaskClient
+from seadata.connectors import irods
+from tests.custom import SeadataTests
+
+
+class TestApp(SeadataTests):
+    def test_01(self, client: FlaskClient, faker: Faker) -> None:
+
+        with irods.get_instance() as imain:
+            home = imain.get_user_home()
+            root = f"{home}/{faker.pystr()}"
+            # a sibling sharing the name of the root as prefix
+            sibling = f"{root}_old"
+
+            imain.create_directory(f"{root}/sub", ignore_existing=True)
+            imain.create_directory(sibling, ignore_existing=True)
+            for path in (f"{root}/a.txt", f"{root}/sub/b.txt", f"{sibling}/c.txt"):
+                imain.create_empty(path)
+                imain.write_file_content(path, "content")
+
+            imain.set_metadata(f"{root}/sub/b.txt", PID="21.T12995/b")
+            imain.set_metadata(f"{sibling}/c.txt", PID="21.T12995/c")
+
+            try:
+                pids = dict(imain.iterate_pids(root))
+                assert pids == {f"{root}/sub/b.txt": "21.T12995/b"}
+
+                pids = dict(imain.iterate_pids(f"{root}/sub"))
+                assert pids == {f"{root}/sub/b.txt": "21.T12995/b"}
+
+                pids = dict(imain.iterate_pids(sibling))
+                assert pids == {f"{sibling}/c.txt": "21.T12995/c"}
+
+                files = {f[0]: f for f in imain.iterate_files(root)}
+                # objects of the root collection and of its subcollections only,
+                # streamed by collection
+                assert list(files) == [f"{root}/a.txt", f"{root}/sub/b.txt"]
+                assert files[f"{root}/a.txt"][1] == len("content")
+                assert files[f"{root}/a.txt"][3] is None
+                assert files[f"{root}/sub/b.txt"][3] == "21.T12995/b"
+
+                files = {f[0]: f for f in imain.iterate_files(f"{root}/")}
+                assert sorted(files) == [f"{root}/a.txt", f"{root}/sub/b.txt"]
+
+                files = {f[0]: f for f in imain.iterate_files(f"{root}/sub")}
+                assert list(files) == [f"{root}/sub/b.txt"]
+
+                files = {f[0]: f for f in imain.iterate_files(f"{root}_missing")}
+                assert not files
+            finally:
+                imain.remove(root, recursive=True, force=True)
+                imain.remove(sibling, recursive=True, force=True)
@@ -1,4 +1,12 @@
+from faker import Faker
+from restapi.connectors import redis
 from restapi.tests import API_URI, FlaskClient
+from seadata.connectors.pids_cache import (
+    PIDS_KEY,
+    RESOLVED_PREFIX,
+    PIDCache,
+    ResolvedPIDCache,
+)
 from tests.custom import SeadataTests
 
 
@@ -41,6 +49,55 @@ def test_01(self, client: FlaskClient) -> None:
 
         r = client.get(f"{API_URI}/pidcache", headers=headers)
         assert r.status_code == 200
+        stats = self.get_content(r)
+        assert isinstance(stats, dict)
+        assert "total" in stats
+        assert "prefixes" in stats
+        assert "batches" in stats
+        assert isinstance(stats["prefixes"], dict)
+        assert isinstance(stats["batches"], dict)
+
+        r = client.get(f"{API_URI}/pidcache?audit=true", headers=headers)
+        assert r.status_code == 200
 
         r = client.post(f"{API_URI}/pidcache/my_batch", headers=headers)
         assert r.status_code == 404
+
+    def test_02(self, faker: Faker) -> None:
+
+        r = redis.get_instance().r
+        cache = PIDCache(r)
+        batch_id = faker.pystr()
+        pid = f"21.T12995/{faker.pystr()}"
+        path = f"/tempZone/cloud/{batch_id}/{faker.pystr()}.txt"
+
+        # PID cached as a plain key, as by the older versions
+        r.set(pid, path)
+        # resolved PIDs contain a slash too
+        resolved = ResolvedPIDCache(ttl=60)
+        resolved.set(r, pid, {"path": path})
+        # other data with a slash in the key or with a PID-like key
+        other_key = f"other/{faker.pystr()}"
+        r.set(other_key, path)
+        not_a_path = f"21.T12995/{faker.pystr()}"
+        r.set(not_a_path, faker.pystr())
+        try:
+            stats = cache.audit()
+            assert stats["legacy"] >= 1
+            # legacy PIDs are migrated into the hashes
+            assert cache.get(pid) == path
+            assert cache.count(batch_id) == 1
+            assert not r.hexists(PIDS_KEY, f"{RESOLVED_PREFIX}{pid}")
+            assert not r.hexists(PIDS_KEY, other_key)
+            assert not r.hexists(PIDS_KEY, not_a_path)
+            assert r.get(other_key).decode() == path
+
+            counters = cache.get_stats()
+            assert counters["total"] == stats["total"]
+            assert sum(counters["prefixes"].values()) == counters["total"]
+            assert counters["prefixes"] == stats["prefixes"]
+        finally:
+            cache.invalidate(batch_id)
+            r.delete(pid, f"{RESOLVED_PREFIX}{pid}", other_key, not_a_path)
+
+        assert cache.get(pid) is None
@@ -0,0 +1,147 @@
+from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, Iterator, List, Optional
+
+import pytest
+from seadata.connectors.irods import IrodsException, transfers
+from seadata.connectors.irods.transfers import Stage, parallel_fetch, run_pipeline
+from tests.custom import SeadataTests
+
+
+class FakeSession:
+    """Stands for an iRODS session, never used by the fake handlers"""
+
+    def __init__(self) -> None:
+        self.closed = False
+
+    def disconnect(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def record(seen: List[Any]) -> transfers.StageHandler:
+    def handler(imain: Any, batch: List[Any]) -> List[Optional[Any]]:
+        seen.extend(batch)
+        return [None] * len(batch)
+
+    return handler
+
+
+class TestApp(SeadataTests):
+    def test_01(self, monkeypatch: pytest.MonkeyPatch) -> None:
+
+        monkeypatch.setattr(transfers, "get_instance", FakeSession)
+        items = list(range(20))
+
+        # single workers preserve the input order in every stage
+        first: List[int] = []
+        second: List[int] = []
+        stages = [Stage("first", record(first)), Stage("second", record(second))]
+        results = list(run_pipeline(items, stages, queue_size=2))
+        assert [item for item, _, _ in results] == items
+        assert all(stage is None and failure is None for _, stage, failure in results)
+        assert first == items
+        assert second == items
+
+        # items failed in a stage do not reach the next ones
+        def odd(imain: Any, batch: List[int]) -> List[Optional[Any]]:
+            return ["odd" if item % 2 else None for item in batch]
+
+        second = []
+        stages = [
+            Stage("odd", odd, workers=3, batch_size=4),
+            Stage("second", record(second), workers=2),
+        ]
+        results = list(run_pipeline(items, stages))
+        assert sorted(item for item, _, _ in results) == items
+        failed = {item: (stage, failure) for item, stage, failure in results if stage}
+        assert sorted(failed) == [i for i in items if i % 2]
+        assert set(failed.values()) == {("odd", "odd")}
+        assert sorted(second) == [i for i in items if i % 2 == 0]
+
+        # an exception is the failure of all the items of the batch
+        def explode(imain: Any, batch: List[int]) -> List[Optional[Any]]:
+            if 5 in batch:
+                raise RuntimeError("boom")
+            return [None] * len(batch)
+
+        results = list(run_pipeline(items, [Stage("explode", explode)]))
+        failed = {item: failure for item, stage, failure in results if stage}
+        assert list(failed) == [5]
+        assert isinstance(failed[5], RuntimeError)
+
+        # as a handler returning a result for some of the items only
+        def short(imain: Any, batch: List[int]) -> List[Optional[Any]]:
+            return [None] * (len(batch) - 1)
+
+        stages = [Stage("short", short, batch_size=4), Stage("next", record([]))]
+        results = list(run_pipeline(items, stages))
+        assert sorted(item for item, _, _ in results) == items
+        assert all(stage == "short" for _, stage, _ in results)
+        assert all(isinstance(failure, ValueError) for _, _, failure in results)
+
+        # a failing input does not block the pipeline and is raised at the end
+        def broken_input() -> Iterator[int]:
+            yield from range(3)
+            raise OSError("input failed")
+
+        completed: List[int] = []
+        with pytest.raises(OSError, match="input failed"):
+            for item, _, _ in run_pipeline(broken_input(), [Stage("ok", record([]))]):
+                completed.append(item)
+        assert completed == [0, 1, 2]
+
+    def test_02(self, monkeypatch: pytest.MonkeyPatch) -> None:
+
+        sessions: List[FakeSession] = []
+
+        def get_instance() -> FakeSession:
+            session = FakeSession()
+            sessions.append(session)
+            return session
+
+        monkeypatch.setattr(transfers, "get_instance", get_instance)
+        monkeypatch.setattr(transfers, "RETRY_WAIT", 0)
+
+        files = {f"file{i}": Path(f"/zone/batch/file{i}") for i in range(20)}
+        files["flaky"] = Path("/zone/batch/flaky")
+        files["missing"] = Path("/zone/batch/missing")
+        files["broken"] = Path("/zone/batch/broken")
+        attempts: Dict[str, int] = {}
+        lock = Lock()
+
+        def transfer(imain: Any, key: str, ipath: Path) -> str:
+            assert isinstance(imain, FakeSession) and not imain.closed
+            with lock:
+                attempts[key] = attempts.get(key, 0) + 1
+            if key == "flaky" and attempts[key] == 1:
+                raise ConnectionError("dropped")
+            if key == "missing":
+                raise IrodsException("not found")
+            if key == "broken":
+                raise OSError("always failing")
+            return ipath.name
+
+        results = {
+            key: (ipath, output, error)
+            for key, ipath, output, error in parallel_fetch(
+                files, transfer, workers=4, retries=3
+            )
+        }
+        assert set(results) == set(files)
+        for i in range(20):
+            assert results[f"file{i}"] == (files[f"file{i}"], f"file{i}", None)
+
+        # transient errors are retried, iRODS errors are not
+        assert results["flaky"][1:] == ("flaky", None)
+        assert attempts["flaky"] == 2
+        assert isinstance(results["missing"][2], IrodsException)
+        assert attempts["missing"] == 1
+        assert isinstance(results["broken"][2], OSError)
+        assert attempts["broken"] == 3
+
+        # sessions failed on a transient error are closed and never reused
+        assert sum(session.closed for session in sessions) == 3
+        assert len(sessions) <= 4 + 3
@@ -0,0 +1,158 @@
+import io
+import zipfile
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+from seadata.tasks.zip_utils import (
+    SplitZipWriter,
+    StreamingZipWriter,
+    ZipEntryTooLarge,
+    count_zip_entries,
+    split_zip,
+)
+from tests.custom import SeadataTests
+
+
+class BrokenStream(io.RawIOBase):
+    """A source failing in the middle of the copy, as a dropped connection"""
+
+    def readinto(self, buffer: bytearray) -> int:  # type: ignore
+        raise OSError("connection lost")
+
+
+def read_parts(parts: List[Path]) -> Dict[str, bytes]:
+    contents: Dict[str, bytes] = {}
+    for part in parts:
+        with zipfile.ZipFile(part) as zip_ref:
+            assert zip_ref.testzip() is None
+            assert zip_ref.namelist()
+            for name in zip_ref.namelist():
+                contents[name] = zip_ref.read(name)
+    return contents
+
+
+class TestApp(SeadataTests):
+    def test_01(self, tmp_path: Path) -> None:
+
+        max_size = 4096
+        data = {f"file{i}.zip": bytes([i]) * 1000 for i in range(6)}
+        with SplitZipWriter(tmp_path, "order_", max_size) as writer:
+            for name, content in data.items():
+                writer.add_stream(name, io.BytesIO(content), size=len(content))
+
+            # stored entries larger than a part are rejected before a rollover
+            parts = len(writer.parts)
+            with pytest.raises(ZipEntryTooLarge):
+                writer.add_stream("big.zip", io.BytesIO(b"0" * 5000), size=5000)
+            assert len(writer.parts) == parts
+
+            # a failed entry in a new part leaves it empty, then it is dropped
+            with pytest.raises(OSError):
+                writer.add_stream("broken.zip", BrokenStream(), size=3000)
+            assert len(writer.parts) == parts + 1
+
+        assert len(writer.parts) == parts
+        assert writer.parts == [
+            tmp_path.joinpath(f"order_{i}.zip") for i in range(1, parts + 1)
+        ]
+        assert sorted(tmp_path.iterdir()) == sorted(writer.parts)
+        assert parts > 1
+        assert all(part.stat().st_size <= max_size for part in writer.parts)
+        assert writer.entries == len(data)
+        assert read_parts(writer.parts) == data
+
+        # an empty part is filled by the next entry
+        with SplitZipWriter(tmp_path, "other_", max_size, first_index=3) as writer:
+            with pytest.raises(OSError):
+                writer.add_stream("broken.txt", BrokenStream(), size=10)
+            writer.add_stream("ok.txt", io.BytesIO(b"ok"), size=2)
+        assert writer.parts == [tmp_path.joinpath("other_3.zip")]
+        assert read_parts(writer.parts) == {"ok.txt": b"ok"}
+
+        # nothing is left without entries
+        with SplitZipWriter(tmp_path, "empty_", max_size) as writer:
+            with pytest.raises(OSError):
+                writer.add_stream("broken.txt", BrokenStream(), size=10)
+        assert not writer.parts
+        assert not tmp_path.joinpath("empty_1.zip").exists()
+
+    def test_02(self, tmp_path: Path) -> None:
+
+        source = tmp_path.joinpath("source.zip")
+        data = {f"dir/file{i}.txt": f"{i}".encode() * 1500 for i in range(8)}
+        with zipfile.ZipFile(source, "w", compression=zipfile.ZIP_STORED) as zip_ref:
+            zip_ref.writestr("dir/", b"")
+            for name, content in data.items():
+                zip_ref.writestr(name, content)
+
+        output = tmp_path.joinpath("split")
+        output.mkdir()
+        parts = split_zip(source, output, "order_", 4096, first_index=2)
+        assert len(parts) > 1
+        assert parts[0] == output.joinpath("order_2.zip")
+        assert all(part.stat().st_size <= 4096 for part in parts)
+        # folders are not copied, files keep their (stored) contents
+        assert read_parts(parts) == data
+
+    def test_03(self, tmp_path: Path) -> None:
+
+        path = tmp_path.joinpath("order.zip")
+        with StreamingZipWriter(path) as writer:
+            writer.add_stream("data.txt", io.BytesIO(b"a" * 1000), size=1000)
+            # already compressed data is stored as it is
+            writer.add_stream("image.PNG", io.BytesIO(b"b" * 1000))
+            writer.add_stream("raw.txt", io.BytesIO(b"c" * 10), stored=True)
+            # a failed copy leaves no partial entry
+            with pytest.raises(OSError):
+                writer.add_stream("broken.txt", BrokenStream(), size=100)
+            writer.add_stream("last.txt", io.BytesIO(b"d" * 10))
+            assert writer.entries == 4
+
+        with zipfile.ZipFile(path) as zip_ref:
+            assert zip_ref.testzip() is None
+            assert zip_ref.namelist() == [
+                "data.txt",
+                "image.PNG",
+                "raw.txt",
+                "last.txt",
+            ]
+            infos = {info.filename: info for info in zip_ref.infolist()}
+            assert infos["data.txt"].compress_type == zipfile.ZIP_DEFLATED
+            assert infos["image.PNG"].compress_type == zipfile.ZIP_STORED
+            assert infos["raw.txt"].compress_type == zipfile.ZIP_STORED
+            assert zip_ref.read("image.PNG") == b"b" * 1000
+            assert zip_ref.read("last.txt") == b"d" * 10
+
+    def test_04(self, tmp_path: Path) -> None:
+
+        path = tmp_path.joinpath("partner.zip")
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as zip_ref:
+            zip_ref.writestr("a.txt", b"a" * 100)
+            zip_ref.writestr("dir/", b"")
+            zip_ref.writestr("dir/b.txt", b"b")
+            zip_ref.writestr("dir/sub/c.txt", b"c")
+        # files or folders created in the root by the extraction
+        assert count_zip_entries(path) == 2
+        assert count_zip_entries(path, check_crc=True) == 2
+
+        for name in ("../evil.txt", "dir/../../evil.txt", "/etc/evil", "..\\evil"):
+            unsafe = tmp_path.joinpath("unsafe.zip")
+            with zipfile.ZipFile(unsafe, "w") as zip_ref:
+                zip_ref.writestr("ok.txt", b"ok")
+                zip_ref.writestr(zipfile.ZipInfo(name), b"evil")
+            with pytest.raises(zipfile.BadZipFile, match="Unsafe entry name"):
+                count_zip_entries(unsafe)
+
+        # corrupted data is only found by the CRC check
+        content = bytearray(path.read_bytes())
+        offset = content.index(b"a" * 100)
+        content[offset] = ord("x")
+        path.write_bytes(bytes(content))
+        assert count_zip_entries(path) == 2
+        with pytest.raises(zipfile.BadZipFile, match="Bad CRC"):
+            count_zip_entries(path, check_crc=True)
+
+        path.write_bytes(b"not a zip")
+        with pytest.raises(zipfile.BadZipFile):
+            count_zip_entries(path)